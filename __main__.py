@@ -13,7 +13,10 @@ if __name__ == '__main__':
             'a customisable command line tool and application programming '
             'interface',
         prog='tagger',
-        usage='python -m tagger [-h] -d FILE [-p DIR] [-w]',
+        usage='python -m tagger [-h] -d FILE [-p DIR] [-w] '
+              '[--script FILE | -c COMMANDS] [--keep-going] [--yes] '
+              '[--serve ADDRESS | --connect ADDRESS] [--async] [--lazy] '
+              '[--watch]',
         epilog='See https://github.com/nchauhan890/tagger for more '
             'information'
     )
@@ -23,16 +26,71 @@ if __name__ == '__main__':
                         help='alternative location to look for plugins')
     parser.add_argument('-w', '--warnings', action='store_true',
                         help='cause warnings to be raised as errors')
+    parser.add_argument('--script', metavar='FILE',
+                        help='run the commands in FILE (- for stdin) '
+                             'instead of the interactive prompt')
+    parser.add_argument('-c', '--command', action='append', metavar='CMDS',
+                        help='run the given command line(s) instead of the '
+                             'interactive prompt')
+    parser.add_argument('--keep-going', action='store_true',
+                        help='continue a script after a command fails')
+    parser.add_argument('--yes', action='store_true',
+                        help='answer yes to confirmation prompts in scripts')
+    parser.add_argument('--serve', metavar='ADDRESS',
+                        help='serve the data tree to clients on a Unix '
+                             'socket path, port or host:port')
+    parser.add_argument('--connect', metavar='ADDRESS',
+                        help='run the script or command lines on a '
+                             'running server instead of a local tree')
+    parser.add_argument('--async', action='store_true', dest='use_async',
+                        help='run the interactive prompt on an asyncio '
+                             'event loop')
+    parser.add_argument('--lazy', action='store_true',
+                        help='parse each top-level node\'s descendants only '
+                             'when they are first used')
+    parser.add_argument('--watch', action='store_true',
+                        help='reload the parts of the data file edited '
+                             'outside tagger while it runs')
     args = parser.parse_args()
-    api.log.is_startup = True
+    script = None
+    if args.script == '-':
+        script = sys.stdin.read().splitlines()
+    elif args.script:
+        with open(args.script) as f:
+            script = f.read().splitlines()
+    if args.command:
+        script = (script or []) + args.command
+    if args.connect:
+        from tagger import server
+        try:
+            sys.exit(server.run_client(args.connect, script or [],
+                                       keep_going=args.keep_going))
+        except OSError as e:
+            sys.exit(f'Could not connect to {args.connect}: {e}')
+    api.log.is_startup = script is None
     api.manual_setup(
         data_source=args.data, warnings=args.warnings,
         alternative_plugins_dir=args.plugins
     )
     try:
-        api.make_tree()
+        api.make_tree(lazy=args.lazy)
     except api.APIWarning as e:
         print('API Warning:', e)
+        if script is not None:
+            sys.exit(1)
     else:
         api.log.is_startup = False
-        api.run()
+        if args.watch:
+            api.watcher.configure(1)
+        if args.serve:
+            from tagger import server
+            server.serve(args.serve)
+            sys.exit()
+        if script is not None:
+            sys.exit(api.run_script(script, keep_going=args.keep_going,
+                                    answer='yes' if args.yes else None))
+        if args.use_async:
+            import asyncio
+            asyncio.run(api.run_async())
+        else:
+            api.run()
@@ -1,25 +1,38 @@
 """API to perform base functions of data traversal."""
 
+import io
 import os
 import os.path
 import sys
 import copy
+import asyncio
+import difflib
+import inspect
+import collections
+import threading
 import importlib
 import importlib.util
+from time import perf_counter, monotonic
 from functools import wraps
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager, suppress
 from string import ascii_letters
 
 from tagger import structure
 from tagger import lexers
 from tagger import parsers
+from tagger import compression
+from tagger import shards
+from tagger.profiler import Profiler
 
-tree = None
+# tree, registry, command_queue, post_commands and autosave are attributes
+# of the current Session, forwarded by the module class (see the end)
 _saved_trees = []
-registry = {}
+_background_tasks = set()  # tasks started by api.background()
+profiler = Profiler()
+_registry = {}  # registered commands, shared by every session
 loaders = {}
-command_queue = []  # the list of current commands that needs to be executed
-post_commands = []  # commands that will be executed after all of the ones
-                    # in command_queue have finished (used for InCommand)
 _log = {
     'unsaved_changes': False,         # the log holds information that is
     'plugin_file': None,              # meant to be accessible to plugins
@@ -37,6 +50,8 @@ _log = {
     'disabled': [],
     'disable_all': False,
     'currently_importing': None,
+    'link_tags': ['link'],            # tags whose values link to other nodes
+    'interactive': True,              # False when running a command script
 }
 _hook_names = {
     'pre_node_creation_hook': None,  # hooks won't be registered if not in
@@ -51,6 +66,12 @@ _hook_names = {
     'inspect_post_commands': [],     # return values of multiple-function
     'capture_return': [],            # hooks will be discarded
     'startup_hook': [],
+    'change_hook': [],
+}
+_hook_passthrough = {            # the argument returned by single hooks
+    'pre_node_creation_hook': 0,  # that leave their input unchanged, so
+    'tag_name_hook': 2,           # that calls to them can be skipped
+    'tag_value_hook': 3,
 }
 
 
@@ -61,13 +82,34 @@ def _initialise_plugin():
         getter_hook=structure.error_if_test(
             lambda x: x is None,
             'default hook may not have been registered as fallback: '
-        )
+        ),
+        passthrough=_hook_passthrough
     )
 
 
+class _SessionLog(collections.abc.MutableMapping):
+    """Mapping of the log values of the current session."""
+
+    def __getitem__(self, k):
+        return _local.session.log_values[k]
+
+    def __setitem__(self, k, v):
+        _local.session.log_values[k] = v
+
+    def __delitem__(self, k):
+        del _local.session.log_values[k]
+
+    def __iter__(self):
+        return iter(_local.session.log_values)
+
+    def __len__(self):
+        return len(_local.session.log_values)
+
+
 plugin = _initialise_plugin()
 log = structure.NameDispatcher(
-    _log, setter_hook=structure.warn_if_new('assigned to new log name: ')
+    _SessionLog(),
+    setter_hook=structure.warn_if_new('assigned to new log name: ')
 )
 
 
@@ -196,14 +238,16 @@ def _import_base_plugin(*, reload=False):
 
 def reload_plugins(*, clean=False):
     """Reload all plugins if a plugin file was updated."""
-    global registry, plugin
+    global plugin
     plugin = _initialise_plugin()
     if clean:
-        registry = {}
+        _registry.clear()
+        _local.session.registry.maps[0].clear()
     log.new_commands = 0
     _import_base_plugin(reload=True)
     log.new_hooks = 0
     log.new_loaders = 0
+    tree = _local.session.tree
     if tree is not None:
         log.plugin_file = tree.root.tags.get('config', log.plugin_file)
         # attempt to update the plugin config using the data tree
@@ -259,18 +303,521 @@ def _append_floating_hooks():
         else:
             remainder.append(func)
     Hooks.floating_functions = remainder
+    plugin.compile()
 
 
 def edits(func):
     """Decorator to indicate that the function modifies the data tree."""
     @wraps(func)
     def wrapper(*args, **kw):
-        r = func(*args, **kw)
-        log.unsaved_changes = True
+        session = _local.session
+        acquired = session.lock.acquire_write()
+        try:
+            r = func(*args, **kw)
+            if session.batch is None:
+                log.unsaved_changes = True
+            else:
+                session.batch.edited = True
+            session.autosave.edit_count += 1
+        finally:
+            if acquired:
+                session.lock.release_write()
         return r
     return wrapper
 
 
+class Batch:
+    """Collect the changes made by API functions inside api.batch()."""
+
+    _missing = object()
+
+    def __init__(self, rollback=True):
+        self.nodes = {}      # changed node -> whether its ID needs updating
+        self.states = {}     # node -> state before its first edit
+        self.edited = False
+        self.rollback_enabled = rollback
+
+    def save_state(self, node):
+        """Save a node's state before it is first edited in the batch."""
+        if node in self.states:
+            return
+        tags = {k: v.copy() if isinstance(v, list) else v
+                for k, v in node.tags.items()}
+        self.states[node] = (
+            node.data, node.id, tags, list(node.children),
+            node.__dict__.get('parent', self._missing),
+            node.__dict__.get('_deleted', self._missing)
+        )
+
+    def rollback(self):
+        """Restore every edited node to its state before the batch."""
+        for node, state in self.states.items():
+            data, id, tags, children, parent, deleted = state
+            node.data, node.id = data, id
+            node.tags.clear()
+            node.tags.update(tags)
+            node.children[:] = children
+            for name, value in (('parent', parent), ('_deleted', deleted)):
+                if value is self._missing:
+                    node.__dict__.pop(name, None)
+                else:
+                    setattr(node, name, value)
+        tree = _local.session.tree
+        if self.states and tree is not None:
+            tree.links = None  # rebuilt from the restored tree on next use
+
+    def commit(self):
+        """Apply the deferred per-edit work once for every changed node."""
+        used = {}  # parent -> IDs of its children, collected once
+        for node, update_id in self.nodes.items():
+            if update_id:
+                parent = getattr(node, 'parent', None)
+                if parent not in used:
+                    used[parent] = structure.sibling_ids(node)
+                node.update_id(used[parent])
+            _update_links(node)
+        if self.nodes and not plugin.elided('change_hook'):
+            plugin.change_hook(list(self.nodes))
+        if self.edited:
+            log.unsaved_changes = True
+
+
+@contextmanager
+def batch(*, rollback=True):
+    """Group API edits so that per-edit work is done once at the end.
+
+    rollback: [default=True] restore edited nodes if an exception is raised
+
+    Inside the block, node IDs are recomputed once per changed node, the
+    change hook is called once with every changed node and
+    log.unsaved_changes is set once, all when the block exits. Nested
+    blocks join the outermost one.
+
+    return: context manager yielding the active Batch
+    """
+    session = _local.session
+    with session.lock.write():
+        # another thread's batch holds the lock until it is committed
+        if session.batch is not None:
+            yield session.batch
+            return
+        session.batch = current = Batch(rollback)
+        try:
+            yield current
+        except BaseException:
+            session.batch = None
+            if rollback:
+                current.rollback()
+            raise
+        session.batch = None
+        current.commit()
+
+
+class Autosaver:
+    """Save copies of the data tree to a file in the background.
+
+    A save is due after a number of seconds and/or a number of edits. The
+    tree is copied with shards.snapshot() while no command is running
+    (between commands, or while the CLI waits for input), then a loader
+    writes the copy on another thread to a temporary file which replaces
+    the autosave file.
+    """
+
+    def __init__(self, session):
+        self.session = session   # the Session whose tree is saved
+        self.interval = None     # seconds between saves
+        self.edits = None        # edits between saves
+        self.file = None         # if None, derived from log.data_source
+        self.loader = 'default'
+        self.edit_count = 0      # edits since the last save
+        self.last_save = monotonic()
+        self.last_file = None    # file written by the last successful save
+        self.error = None        # exception raised by the last write
+        self.idle = False        # True while the CLI waits for input
+        self._idle_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._writer = None
+
+    @property
+    def enabled(self):
+        return self.interval is not None or self.edits is not None
+
+    def configure(self, interval=None, edits=None, file=None,
+                  loader='default'):
+        """Turn on autosaving; with no interval or edits, turn it off.
+
+        interval: [optional] seconds after which edits are saved [int]
+        edits: [optional] number of edits after which to save [int]
+        file: [optional] autosave file; defaults to the data source with
+              '.autosave' before its extension [str]
+        loader: [default='default'] loader whose save method is used [str]
+        """
+        if loader not in loaders:
+            raise CommandError(f'no loader \'{loader}\'')
+        self._stop.set()  # end the timer of the previous configuration
+        self.interval, self.edits = interval, edits
+        self.file, self.loader = file, loader
+        self.edit_count = 0
+        self.last_save = monotonic()
+        if interval is not None:
+            self._stop = threading.Event()
+            threading.Thread(target=self._run_timer,
+                             args=(interval, self._stop),
+                             name='tagger-autosave', daemon=True).start()
+
+    def due(self):
+        """Indicate whether there are edits which should now be saved."""
+        if not self.edit_count:
+            return False
+        if self.edits is not None and self.edit_count >= self.edits:
+            return True
+        return (self.interval is not None
+                and monotonic() - self.last_save >= self.interval)
+
+    def maybe_save(self):
+        """Start a save if one is due (called between commands)."""
+        if self.enabled and self.session.tree is not None and self.due():
+            self.save()
+
+    def save(self):
+        """Copy the tree and start writing the copy on another thread.
+
+        A loader whose save method has no 'root' parameter can only save
+        the live tree, so it writes before this returns.
+
+        return: the file being written, or None if the previous save is
+                still being written [str]
+        """
+        if self._writer is not None and self._writer.is_alive():
+            return None  # tried again after the next command
+        file = self.file or self.default_file()
+        loader = loaders[self.loader]()
+        self.edit_count = 0
+        self.last_save = monotonic()
+        if 'root' not in inspect.signature(loader.save).parameters:
+            self._write(loader, None, file)
+            return file
+        root = shards.snapshot(self.session.tree.root, file, self.copy_name)
+        self._writer = threading.Thread(target=self._write,
+                                        args=(loader, root, file),
+                                        name='tagger-autosave-writer')
+        self._writer.start()
+        return file
+
+    def default_file(self):
+        source = self.session.log_values['data_source']
+        return self.copy_name(source or 'output.txt')
+
+    @staticmethod
+    def copy_name(file):
+        """Return the name of the autosave copy of a file."""
+        base, ext = os.path.splitext(file)
+        return f'{base}.autosave{ext}'
+
+    def wait(self):
+        """Wait for a save being written to finish."""
+        if self._writer is not None:
+            self._writer.join()
+
+    def read_input(self):
+        """Call input(), allowing timed saves while it waits."""
+        with self._idle_lock:
+            self.idle = True
+        try:
+            return input()
+        finally:
+            with self._idle_lock:  # waits for a snapshot being taken
+                self.idle = False
+
+    def _run_timer(self, interval, stop):
+        with self.session:  # a loader may save the session's live tree
+            while not stop.wait(interval):
+                with self._idle_lock:
+                    if self.idle and self.due():
+                        self.maybe_save()
+
+    def _write(self, loader, root, file):
+        base, ext = os.path.splitext(file)
+        temp = f'{base}.{os.getpid()}.tmp{ext}'  # same directory as file;
+        # the suffix is kept, as it picks the compression of the output
+        try:
+            if root is None:
+                loader.save(temp)
+            else:
+                loader.save(temp, root=root)
+            os.replace(temp, file)  # readers never see a partial file
+        except Exception as e:
+            self.error = e
+            with suppress(OSError):
+                os.remove(temp)
+        else:
+            self.error = None
+            self.last_file = file
+
+
+class Watcher:
+    """Reload the parts of the data file edited outside the session.
+
+    The size and modification time of the file are polled on another
+    thread. When they change, the file's top-level sections are compared
+    with the text each top-level node was parsed from, and only sections
+    which changed are parsed again. Their nodes replace the old ones while
+    no command is running (between commands, or while the CLI waits for
+    input), so the current node is kept unless it was in a replaced
+    section; then the node with the same path of IDs in the new section
+    is used, or as much of the path as still exists. A change to the
+    title or root tags reloads the whole file.
+
+    Nothing is reloaded while the tree has unsaved changes.
+    """
+
+    def __init__(self, session):
+        self.session = session  # the Session whose tree is reloaded
+        self.interval = None    # seconds between checks of the file
+        self.file = None
+        self.stat = None        # size and mtime of the file when read
+        self.root = None        # root of the tree read from the file
+        self.head = None        # text of the title and root tags
+        self.sections = None    # (text, node) of each top-level node, or
+                                # None if they do not match the file's
+        self._stop = threading.Event()
+
+    @property
+    def enabled(self):
+        return self.interval is not None
+
+    def configure(self, interval=None):
+        """Start watching the data source; with no interval, stop.
+
+        interval: [optional] seconds between checks of the file [int]
+        """
+        self._stop.set()  # end the thread of the previous configuration
+        self.interval = None
+        if interval is None:
+            return
+        tree = self.session.tree
+        file = self.session.log_values['data_source']
+        if tree is None or not file:
+            raise CommandError('no data file to watch')
+        if tree.partial:
+            raise CommandError('a tree holding only a subtree of its file '
+                               'cannot be watched')
+        root = tree.root
+        if getattr(root, '_store', None) is not None or any(
+                isinstance(child, structure.LazyNode)
+                and not hasattr(child, 'shard') for child in root.children):
+            raise CommandError('only a data tree parsed in full from the '
+                               'tagger format can be watched')
+        self.file = file
+        self.remember()
+        self.interval = interval
+        self._stop = threading.Event()
+        threading.Thread(target=self._run_timer, args=(interval, self._stop),
+                         name='tagger-watch', daemon=True).start()
+
+    def remember(self):
+        """Record the file as it is now as the source of the tree.
+
+        Called after the tree is saved to the file.
+        """
+        stat = _file_stat(self.file)
+        with compression.open_source(self.file) as f:
+            source = f.read()
+        self.stat = stat
+        self.head, sections = parsers.top_level_sections(source)
+        self.root = self.session.tree.root
+        children = self.root.children
+        self.sections = None
+        if len(children) == len(sections):
+            self.sections = [(text, node) for (text, _), node
+                             in zip(sections, children)]
+
+    def changed(self):
+        return self.enabled and _file_stat(self.file) not in (None,
+                                                              self.stat)
+
+    def maybe_reload(self):
+        """Reload the file if it has changed (called between commands)."""
+        if self.session.tree is not None and self.changed():
+            self.reload()
+
+    def reload(self):
+        """Parse the changed sections of the file into the tree."""
+        session = self.session
+        stat = _file_stat(self.file)
+        self.stat = stat  # warned once for each change
+        if session.tree.root is not self.root:
+            print(f'\n{self.file} has changed; it was not reloaded as '
+                  'another tree was loaded')
+            return
+        if session.log_values['unsaved_changes']:
+            print(f'\n{self.file} has changed; it was not reloaded as the '
+                  'tree has unsaved changes')
+            return
+        with compression.open_source(self.file) as f:
+            source = f.read()
+        head, sections = parsers.top_level_sections(source)
+        try:
+            with session, session.write():
+                count = self._splice(source, head, sections)
+        except SyntaxError as e:
+            print(f'\n{self.file} was not reloaded:\n{e}')
+        else:
+            print(f'\nReloaded {count} of {len(sections)} section(s) of '
+                  f'{self.file}')
+
+    def _splice(self, source, head, sections):
+        tree = self.session.tree
+        path = [node.id for node in tree.current_node.traversal_depth[1:]]
+        if head != self.head or self.sections is None:
+            root = parsers.parse_tree(source)
+            shards.mount(root, self.file)
+            self.session.tree = Tree(root)
+            self.session.log_values['unsaved_changes'] = False
+            self.remember()
+            _follow_ids(self.session.tree, path)
+            return len(sections)
+        old = [text for text, _ in self.sections]
+        new = [text for text, _ in sections]
+        matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+        opcodes = matcher.get_opcodes()
+        # parsed before the tree is changed, so a syntax error leaves it
+        changed = [sections[j1:j2] for op, _, _, j1, j2 in opcodes
+                   if op != 'equal']
+        nodes = iter(self._construct(
+            [section for group in changed for section in group]))
+        kept = []
+        count = 0
+        for op, i1, i2, j1, j2 in opcodes:
+            if op == 'equal':
+                kept.extend(self.sections[i1:i2])
+                continue
+            for _, node in self.sections[i1:i2]:
+                node._deleted = True
+            kept.extend((text, next(nodes)) for text, _ in sections[j1:j2])
+            count += j2 - j1
+        tree.root.children[:] = [node for _, node in kept]
+        self.sections = kept
+        tree.links = None  # rebuilt from the tree on next use
+        if any(getattr(node, '_deleted', False)
+               for node in tree.current_node.traversal_depth):
+            tree.current_node = tree.root
+            _follow_ids(tree, path)
+        return count
+
+    def _construct(self, sections):
+        """Create the top-level nodes of sections of the file."""
+        patterns = [pattern for text, line in sections
+                    for pattern in parsers.parse_patterns(text, line)]
+        root = self.session.tree.root
+        # a private session: reloading is not an edit of the tree
+        with Session(self.session.tree,
+                     log_values=dict(self.session.log_values)):
+            nodes = parsers.construct_below(patterns, root)
+        for node in nodes:
+            shards.mount(node, self.file)
+        return nodes
+
+    def _run_timer(self, interval, stop):
+        autosave = self.session.autosave
+        with self.session:
+            while not stop.wait(interval):
+                with autosave._idle_lock:  # the CLI waits while reloading
+                    if autosave.idle:
+                        self.maybe_reload()
+
+
+def _file_stat(file):
+    """Return the size and modification time of a file, or None."""
+    try:
+        stat = os.stat(file)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _follow_ids(tree, path):
+    """Move to the node with a path of IDs, or as far along it as exists."""
+    node = tree.root
+    for id in path:
+        for child in node.children:
+            if child.id == id:
+                node = child
+                break
+        else:
+            break
+    tree.current_node = node
+
+
+class Session:
+    """The state of one data tree, which several threads can share.
+
+    A session owns its tree, the values read through api.log, commands
+    bound with 'bind' or 'alias' (looked up before the registered ones),
+    the command queues, the active api.batch() and its autosave settings.
+    Plugins, hooks and loaders are shared by every session.
+
+    API functions use the session entered by the calling thread with a
+    with statement, or api.default_session. Edits hold the session's write
+    lock; a thread can hold session.read() so that edits wait for it.
+    """
+
+    def __init__(self, tree=None, data_source=None, log_values=None):
+        """Create a session, copying the log values of the default session.
+
+        tree: [optional] data tree of the session [Tree]
+        data_source: [optional] file the tree is loaded from [str]
+        log_values: [optional] dictionary to hold the log values [dict]
+        """
+        if log_values is None:
+            log_values = copy.deepcopy(default_session.log_values)
+            log_values['unsaved_changes'] = False
+            log_values['data_source'] = None
+        if data_source:
+            log_values['data_source'] = os.path.abspath(data_source)
+        self.tree = tree
+        self.log_values = log_values
+        self.registry = collections.ChainMap({}, _registry)
+        self.command_queue = []  # commands that need to be executed
+        self.post_commands = []  # commands that will be executed after
+                                 # those in command_queue (used by InCommand)
+        self.batch = None  # the Batch of the enclosing api.batch() block
+        self.lock = structure.ReadWriteLock()
+        self.autosave = Autosaver(self)
+        self.watcher = Watcher(self)
+
+    def __enter__(self):
+        _local.stack.append(_local.session)
+        _local.session = self
+        return self
+
+    def __exit__(self, *exc):
+        _local.session = _local.stack.pop()
+
+    def read(self):
+        """Return a context manager holding the tree lock for reading."""
+        return self.lock.read()
+
+    def write(self):
+        """Return a context manager holding the tree lock for writing."""
+        return self.lock.write()
+
+
+class _Local(threading.local):
+    def __init__(self):
+        self.session = default_session
+        self.stack = []  # sessions entered before the current one
+
+
+default_session = Session(log_values=_log)
+_local = _Local()
+
+
+def current_session():
+    """Return the session used by API functions in the calling thread."""
+    return _local.session
+
+
 def priority(priority):
     """Decorator to give input handlers a .priority attribute."""
     def wrapper(func):
@@ -312,12 +859,14 @@ class Tree:
         """Initialise a data tree from a root object."""
         self.root = root
         self.current_node = self.root
+        self.links = None  # link index, built on first use
+        self.partial = None  # path of the file, if only a subtree of it
+                             # was loaded
+        _local.session.autosave.edit_count = 0  # edits made building it
 
     @classmethod
-    def from_parser(cls, source):
-        parser = parsers.InputPatternParser(lexers.InputLexer(source))
-        root = parsers.construct_tree(parser)
-        return cls(root)
+    def from_parser(cls, source, workers=None):
+        return cls(parsers.parse_tree(source, workers))
 
 
 def enter_node(index):
@@ -327,6 +876,7 @@ def enter_node(index):
         NodeError raised if index invalid
     return value: None
     """
+    tree = _local.session.tree
     try:
         index = int(index)
     except ValueError:
@@ -346,6 +896,7 @@ def switch_node(node):
     node: node to switch to [NodeType]
     return value: the previous node
     """
+    tree = _local.session.tree
     current = tree.current_node
     if not is_node(node):
         raise NodeError('node is not instance of NodeType')
@@ -359,6 +910,7 @@ def return_from_node():
     NodeError raised if current node is Root
     return value: None
     """
+    tree = _local.session.tree
     if not hasattr(tree.current_node, 'parent'):
         # the root doesn't have a parent node
         raise NodeError('current node is the root of the tree')
@@ -373,34 +925,42 @@ def remove_node(index=None, node=None):
     node: [optional] the node whose child to remove (requires index)
     return value: the removed node
     """
+    tree = _local.session.tree
     if not hasattr(tree.current_node, 'parent') and index is None:
         # the root doesn't have a parent node
         raise NodeError(
             'current node is root of the tree and cannot be removed'
         )
+    if node is None and index is not None:
+        if index >= len(tree.current_node.children):
+            raise NodeError('invalid node index')
+        node = tree.current_node
     if node is not None:
         if index is None:
             raise InputError('index required')
+        _before_edit(node)
         r = node.children.pop(index)
+        _before_edit(r)
+        _unlink_subtree(r)
+        _changed(node, update_id=False, children=True)
         r._deleted = True
         del r.parent
         r.children = []
         return r
-    if index is not None:
-        if index > len(tree.current_node.children):
-            raise NodeError('invalid node index')
-        r = tree.current_node.children.pop(index)
-    else:
-        current = tree.current_node
-        return_from_node()
-        for i, n in enumerate(tree.current_node.children):
-            if n is current:
-                r = tree.current_node.children.pop(i)
-                break
-        r._deleted = True
-        del r.parent
-        r.children = []
-        return r
+    current = tree.current_node
+    return_from_node()
+    _before_edit(tree.current_node)
+    for i, n in enumerate(tree.current_node.children):
+        if n is current:
+            r = tree.current_node.children.pop(i)
+            break
+    _before_edit(r)
+    _unlink_subtree(r)
+    _changed(tree.current_node, update_id=False, children=True)
+    r._deleted = True
+    del r.parent
+    r.children = []
+    return r
 
 
 @edits
@@ -412,15 +972,19 @@ def new_node(data, parent=None):
     return value: Node
     """
     if parent is None:
-        parent = tree.current_node
-    data = plugin.pre_node_creation_hook(
-        data, parent.depth + 1,
-        parent.traversal_depth
-    )
+        parent = _local.session.tree.current_node
+    _before_edit(parent)
+    if not plugin.elided('pre_node_creation_hook'):
+        data = plugin.pre_node_creation_hook(
+            data, parent.depth + 1,
+            parent.traversal_depth
+        )
     if not tests.not_whitespace(data):
         raise NodeError('data cannot be empty')
     node = structure.Node(data, parent.depth + 1, parent)
-    plugin.post_node_creation_hook(node)
+    if not plugin.elided('post_node_creation_hook'):
+        plugin.post_node_creation_hook(node)
+    _changed(node, update_id=False)
     return node
 
 
@@ -434,11 +998,12 @@ def edit_data(new, node=None):
     return value: None
     """
     if node is None:
-        node = tree.current_node
+        node = _local.session.tree.current_node
     if not tests.not_whitespace(new):
         raise NodeError('data cannot be empty')
+    _before_edit(node)
     node.data = new
-    node.update_id()
+    _changed(node)
 
 
 @edits
@@ -450,8 +1015,10 @@ def edit_tag_name(tag, new_tag, node=None, create=False):
     node: [optional] node to use instead
     create: [optional] create a new tag if the tag doesn't exist
     """
+    tree = _local.session.tree
     if node is None:
         node = tree.current_node
+    _before_edit(node)
     try:
         value = tree.current_node.tags.pop(tag)
         # this will remove the current key-value pair
@@ -468,7 +1035,7 @@ def edit_tag_name(tag, new_tag, node=None, create=False):
     if not tests.not_whitespace(new_tag):
         raise NodeError('tag name cannot be empty')
     node.tags[new_tag] = value
-    node.update_id()
+    _changed(node)
 
 
 @edits
@@ -481,7 +1048,7 @@ def edit_tag_value(tag, new_value, node=None, create=False):
     create: [optional] create a new tag if the tag doesn't exist
     """
     if node is None:
-        node = tree.current_node
+        node = _local.session.tree.current_node
     try:
         node.tags[tag]
     except KeyError:
@@ -490,7 +1057,6 @@ def edit_tag_value(tag, new_value, node=None, create=False):
     if isinstance(new_value, list) and not new_value:
         new_value = None
     new_tag(tag, new_value, node)
-    node.update_id()
 
 
 @edits
@@ -502,27 +1068,41 @@ def new_tag(tag, value=None, node=None):
     node: [optional] node to use instead
     """
     if node is None:
-        node = tree.current_node
+        node = _local.session.tree.current_node
+    tag, value = _prepare_tag(node, tag, value)
+    if tag in node.tags:
+        warning('tag already exists')
+    _before_edit(node)
+    node.tags[tag] = value
+    _changed(node)
+
+
+def _prepare_tag(node, tag, value):
+    """Run the input tests and hooks for a tag about to be assigned.
+
+    return: the tag name and value to assign [tuple]
+    """
     if isinstance(value, list) and not value:
         value = None
-    try:
-        plugin.tag_name_input_test(node, None, tag)
-    except TypeError:  # don't handle NodeError so custom message not lost
-        raise NodeError(f'invalid tag name {tag}')
-    tag = plugin.tag_name_hook(node, tag, tag)
-    try:
-        plugin.tag_value_input_test(node, tag, None, value)
-    except TypeError:
-        raise NodeError(f'invalid tag value {value}')
-    value = plugin.tag_value_hook(
-        node, tag, None, value
-    )
+    if not plugin.elided('tag_name_input_test'):
+        try:
+            plugin.tag_name_input_test(node, None, tag)
+        except TypeError:  # NodeError not handled: keeps custom message
+            raise NodeError(f'invalid tag name {tag}')
+    if not plugin.elided('tag_name_hook'):
+        tag = plugin.tag_name_hook(node, tag, tag)
+    if not plugin.elided('tag_value_input_test'):
+        try:
+            plugin.tag_value_input_test(node, tag, None, value)
+        except TypeError:
+            raise NodeError(f'invalid tag value {value}')
+    if not plugin.elided('tag_value_hook'):
+        value = plugin.tag_value_hook(
+            node, tag, None, value
+        )
     if not tests.not_whitespace(tag):
         raise NodeError('tag name cannot be empty')
-    if tag in node.tags:
-        warning('tag already exists')
-    node.tags[tag] = value
-    node.update_id()
+    return tag, value
 
 
 @edits
@@ -535,7 +1115,7 @@ def append_tag_value(tag, new_value, node=None, create=False):
     create: [optional] create a new tag if the tag doesn't exist
     """
     if node is None:
-        node = tree.current_node
+        node = _local.session.tree.current_node
     try:
         current = node.tags[tag]
     except KeyError:
@@ -544,13 +1124,16 @@ def append_tag_value(tag, new_value, node=None, create=False):
             return
         raise NodeError(f'tag \'{tag}\' not found')
 
-    try:
-        plugin.tag_value_input_test(node, tag, node.tags[tag], new_value)
-    except TypeError:
-        raise NodeError(f'invalid tag value {new_value}')
-    new_value = plugin.tag_value_hook(
-        node, tag, node.tags[tag], new_value
-    )
+    if not plugin.elided('tag_value_input_test'):
+        try:
+            plugin.tag_value_input_test(node, tag, node.tags[tag], new_value)
+        except TypeError:
+            raise NodeError(f'invalid tag value {new_value}')
+    if not plugin.elided('tag_value_hook'):
+        new_value = plugin.tag_value_hook(
+            node, tag, node.tags[tag], new_value
+        )
+    _before_edit(node)
     if new_value is None:
         warning('cannot append None value')
     elif isinstance(current, list):
@@ -561,7 +1144,7 @@ def append_tag_value(tag, new_value, node=None, create=False):
         node.tags[tag] = new_value
     else:
         raise NodeError('cannot append tag value')
-    node.update_id()
+    _changed(node)
 
 
 @edits
@@ -573,12 +1156,289 @@ def remove_tag(tag, node=None):
     return value: the value of the removed tag
     """
     if node is None:
-        node = tree.current_node
+        node = _local.session.tree.current_node
+    _before_edit(node)
     try:
-        return node.tags.pop(tag)
+        value = node.tags.pop(tag)
     except KeyError:
         raise NodeError(f'tag \'{tag}\' not found')
-    node.update_id()
+    _changed(node)
+    return value
+
+
+@edits
+def new_nodes(parent, datas):
+    """Create many new nodes as the last children of a node.
+
+    parent: the parent of the new nodes [NodeType]
+    datas: the data held by each new node [list: str]
+
+    All data is checked before any node is created, and the parent's
+    children are extended once.
+
+    return value: the new nodes [list: Node]
+    """
+    depth = parent.depth + 1
+    parents = parent.traversal_depth
+    datas = list(datas)
+    datas = plugin.call_batch('pre_node_creation_hook', datas,
+                              [depth] * len(datas), [parents] * len(datas))
+    if not all(tests.not_whitespace(data) for data in datas):
+        raise NodeError('data cannot be empty')
+    with batch():
+        _before_edit(parent)
+        nodes = [structure.Node(data, depth, parent) for data in datas]
+        parent.children.extend(nodes)
+        plugin.call_batch('post_node_creation_hook', nodes)
+        for node in nodes:
+            _changed(node, update_id=False)
+        _changed(parent, update_id=False, children=True)
+    return nodes
+
+
+@edits
+def new_tags(nodes, tag, values=None):
+    """Create the same tag in many nodes.
+
+    nodes: the nodes to tag [list: NodeType]
+    tag: the name of the tag
+    values: [optional] the value for each node, in the same order
+            (name-only tags if not given) [list]
+    """
+    _set_tags(nodes, tag, values, warn=True)
+
+
+@edits
+def set_tag_values(nodes, tag, values):
+    """Set the value of a tag in many nodes, creating it where needed.
+
+    nodes: the nodes whose tag to set [list: NodeType]
+    tag: the name of the tag
+    values: the value for each node, in the same order [list]
+    """
+    _set_tags(nodes, tag, values, warn=False)
+
+
+def parallel_map(func, nodes, workers=None, chunksize=None, tag=None):
+    """Call a function on copies of subtrees in worker processes.
+
+    func: function called with a structure.SnapshotNode copy of each node
+          and its descendants; it must be defined at module level so that
+          it can be pickled, and return a picklable value
+    nodes: the nodes at the top of the subtrees [list: NodeType]
+    workers: [optional] number of processes; defaults to the CPU count
+    chunksize: [optional] number of subtrees sent to a process at once
+    tag: [optional] tag to set in each node to the result for that node,
+         through set_tag_values
+
+    Subtrees are sent in the compact form made by structure.pack(). With
+    one worker, or one chunk, func is called in this process.
+
+    return: the results, in the same order as nodes [list]
+    """
+    nodes = list(nodes)
+    if not nodes:
+        return []
+    with _local.session.read():
+        packed = [structure.pack(node) for node in nodes]
+    workers = workers or os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = max(1, -(-len(nodes) // (workers * 4)))
+    chunks = [packed[i:i+chunksize] for i in range(0, len(packed), chunksize)]
+    if workers == 1 or len(chunks) == 1:
+        results = [r for chunk in chunks for r in _map_packed(func, chunk)]
+    else:
+        with ProcessPoolExecutor(min(workers, len(chunks))) as executor:
+            results = [
+                r for chunk_results in executor.map(_map_packed, repeat(func),
+                                                    chunks)
+                for r in chunk_results
+            ]
+    if tag is not None:
+        set_tag_values(nodes, tag, results)
+    return results
+
+
+def _map_packed(func, chunk):
+    return [func(structure.unpack(packed)) for packed in chunk]
+
+
+def _set_tags(nodes, tag, values, warn):
+    """Check every tag assignment and then assign them in one batch."""
+    nodes = list(nodes)
+    values = [None] * len(nodes) if values is None else list(values)
+    if len(values) != len(nodes):
+        raise NodeError('number of values must match number of nodes')
+    values = [None if isinstance(v, list) and not v else v for v in values]
+    nones, tags = [None] * len(nodes), [tag] * len(nodes)
+    try:
+        plugin.call_batch('tag_name_input_test', nodes, nones, tags)
+    except TypeError:
+        raise NodeError(f'invalid tag name {tag}')
+    names = plugin.call_batch('tag_name_hook', nodes, tags, tags)
+    try:
+        plugin.call_batch('tag_value_input_test', nodes, names, nones, values)
+    except TypeError:
+        raise NodeError('invalid tag value')
+    values = plugin.call_batch('tag_value_hook', nodes, names, nones, values)
+    if not all(tests.not_whitespace(name) for name in names):
+        raise NodeError('tag name cannot be empty')
+    if warn and any(name in node.tags for node, name in zip(nodes, names)):
+        warning('tag already exists')
+    with batch():
+        for node, name, value in zip(nodes, names, values):
+            _before_edit(node)
+            node.tags[name] = value
+            _changed(node)
+
+
+@edits
+def remove_nodes(nodes):
+    """Remove many nodes from the data tree.
+
+    nodes: the nodes to remove [list: Node]
+
+    Each parent's children are rebuilt once rather than popped per node.
+    If the current node is removed, traversal moves to its parent.
+
+    return value: the removed nodes [list: Node]
+    """
+    tree = _local.session.tree
+    groups = {}  # parent -> {node: None} (ordered set of removed children)
+    for node in nodes:
+        if not hasattr(node, 'parent'):
+            raise NodeError('the root of the tree cannot be removed')
+        groups.setdefault(node.parent, {})[node] = None
+    removed = []
+    with batch():
+        for parent, children in groups.items():
+            _before_edit(parent)
+            parent.children[:] = [c for c in parent.children
+                                  if c not in children]
+            for r in children:
+                _before_edit(r)
+                _unlink_subtree(r)
+                if tree is not None and tree.current_node is r:
+                    tree.current_node = parent
+                r._deleted = True
+                del r.parent
+                r.children = []
+                removed.append(r)
+            _changed(parent, update_id=False, children=True)
+    return removed
+
+
+def link_index():
+    """Return the link index of the data tree, building it if needed.
+
+    The tags treated as links are set by log.link_tags.
+
+    return: [structure.LinkIndex]
+    """
+    tree = _local.session.tree
+    if tree is None:
+        raise NodeError('no data tree to index')
+    links = tree.links
+    if links is None or links.link_tags != frozenset(log.link_tags):
+        links = tree.links = structure.LinkIndex(tree.root, log.link_tags)
+    return links
+
+
+def follow_link(node=None):
+    """Resolve the link tags of a node to their target nodes.
+
+    node: [optional] node to use instead of current
+
+    return: target nodes [list: NodeType]
+    """
+    if node is None:
+        node = _local.session.tree.current_node
+    return link_index().targets(node)
+
+
+def backlinks(node=None):
+    """Find the nodes whose link tags target a node.
+
+    node: [optional] node to use instead of current
+
+    return: linking nodes [list: NodeType]
+    """
+    if node is None:
+        node = _local.session.tree.current_node
+    return link_index().backlinks(node)
+
+
+def reachable(node=None):
+    """Find every node reachable from a node by following links.
+
+    node: [optional] node to use instead of current
+
+    return: reachable nodes in breadth-first order [list: NodeType]
+    """
+    if node is None:
+        node = _local.session.tree.current_node
+    return link_index().reachable(node)
+
+
+def _update_links(node):
+    """Re-index a node in the link index if it belongs to the tree."""
+    tree = _local.session.tree
+    if tree is None or tree.links is None or getattr(node, '_deleted', False):
+        return
+    parents = node.parent_list
+    if (parents[0] if parents else node) is tree.root:
+        tree.links.update(node)
+
+
+def _changed(node, update_id=True, children=False):
+    """Record that an API function changed a node.
+
+    children: [default=False] whether the node's list of children changed,
+              rather than its data or tags
+
+    Outside api.batch() the node's ID and link index entry are updated and
+    the change hook is called straight away; inside a batch this is
+    deferred until the batch is committed.
+    """
+    mark_edited = getattr(node, 'mark_edited', None)
+    if mark_edited is not None:
+        mark_edited()  # a node of tagger.store, written on the next save
+    if shards.mounted:
+        shards.changed(node, children)
+    current = _local.session.batch
+    if current is not None:
+        current.nodes[node] = current.nodes.get(node, False) or update_id
+        return
+    if update_id:
+        node.update_id()
+    _update_links(node)
+    if not plugin.elided('change_hook'):
+        plugin.change_hook([node])
+
+
+def _before_edit(node):
+    """Save the state of a node so an active batch can roll it back."""
+    current = _local.session.batch
+    if current is not None and current.rollback_enabled:
+        current.save_state(node)
+
+
+def _unlink_subtree(node):
+    """Remove a removed node and its descendants from the link index."""
+    tree = _local.session.tree
+    if tree is not None and tree.links is not None:
+        tree.links.remove_subtree(node)
+
+
+def set_profiling(enabled):
+    """Turn timing of hooks, commands, input handlers and loaders on or off.
+
+    enabled: [bool]
+
+    Statistics are kept in api.profiler.
+    """
+    profiler.enabled = bool(enabled)
+    plugin.compile()  # hooks are timed through the dispatch table
 
 
 def exit():
@@ -606,15 +1466,21 @@ def manual_setup(data_source=None, warnings=False,
     log.new_hooks = 0  # the previous import will change this value
 
 
-def make_tree(source=None, file=None, overwrite=True):
+def make_tree(source=None, file=None, overwrite=True, lazy=False,
+              subtree=None):
     """Create a data tree from raw text or a file location.
 
     source: raw text to use to create data tree [str], or;
     file: path to text file to read [str]
     overwrite: [default=True] overwrite the current data tree if one exists
+    lazy: [default=False] parse the descendants of each top-level node of
+          a file only when they are first used (see tagger.lazy)
+    subtree: [optional] absolute node reference of the only subtree to
+             parse, e.g. '~/mr_birling' (see parsers.parse_subtree) [str]
     """
-    global tree
-    if tree is not None and not overwrite:
+    if lazy and subtree is not None:
+        raise ValueError('a subtree cannot be loaded lazily')
+    if _local.session.tree is not None and not overwrite:
         warning(
             'tree already created; use api.make_tree(source, overwrite=True) '
             'to overwrite and stop warning'
@@ -625,20 +1491,74 @@ def make_tree(source=None, file=None, overwrite=True):
                 file = log.data_source
             if not file:
                 raise TypeError('no data source')
-            with open(file, 'r') as f:
-                source = f.read()
+            if lazy:
+                from tagger.lazy import open_tree
+                _local.session.tree = Tree(open_tree(file))
+                log.unsaved_changes = False
+                return
+            from tagger import store
+            if subtree is None and store.is_database(file):
+                _local.session.tree = Tree(store.open_tree(file))
+                log.unsaved_changes = False
+                return
+            with compression.open_source(file) as f:
+                source = f.read()  # decompressed if gzip, bz2 or xz
     except TypeError as e:
         if str(e) != 'no data source':
             raise
     else:
-        tree = Tree.from_parser(source)
+        if subtree is not None:
+            root = parsers.parse_subtree(source, subtree)
+        else:
+            root = parsers.parse_tree(source)
+        shards.mount(root, file)
+        _local.session.tree = Tree(root)
+        if subtree is not None and file:
+            _local.session.tree.partial = os.path.abspath(file)
     log.unsaved_changes = False
     # the construction will call API functions so this must be reset to False
 
 
+def check_save_target(file):
+    """Raise CommandError if saving to a file would lose part of it.
+
+    A tree holding only a subtree of a file (see make_tree) must not be
+    saved over that file.
+
+    file: path of the file the tree is about to be saved to [str]
+    """
+    tree = _local.session.tree
+    if tree is not None and tree.partial == os.path.abspath(file):
+        raise CommandError(
+            f'the tree holds only a subtree of \'{file}\'; saving over it '
+            'would remove the rest of the file, so save it to another file'
+        )
+
+
+def materialize(node=None):
+    """Parse every unparsed section below a node of a lazily loaded tree.
+
+    Needed before a lazily loaded tree is saved over its own file, since
+    unparsed sections are read from the file when they are first used.
+
+    Trees kept in a database (see tagger.store) are left as they are:
+    their nodes can be selected at any time.
+
+    node: [optional] node to use instead of the root
+    """
+    if node is None:
+        node = _local.session.tree.root
+    if getattr(node, '_store', None) is not None:
+        return
+    if shards.mounted:
+        shards.load_all(node)  # in parallel, before the walk
+    for _ in structure.walk(node):
+        pass  # using the children of each node parses its section
+
+
 def run():
     """Run the traversal command line interface."""
-    if tree is None:
+    if _local.session.tree is None:
         prev = log.is_startup
         log.is_startup = True
         initialise_plugins()  # they will not have been initialised
@@ -681,15 +1601,98 @@ def run():
         except ProgramExit:
             break
         except Exception:
-            if tree is not None and log.unsaved_changes:
+            if _local.session.tree is not None and log.unsaved_changes:
                 log.disable_exemptions.append('save')
                 # try to save data before crashing from another error
                 _generate_commands('save and exit')
             raise
 
 
+async def run_async():
+    """Run the command line interface on an asyncio event loop.
+
+    Input is read in an executor thread, so tasks started with
+    api.background() keep running while the prompt waits. Commands from one
+    input line run in order, and a command whose execute method is a
+    coroutine function is awaited before the next one starts.
+    """
+    if _local.session.tree is None:
+        prev = log.is_startup
+        log.is_startup = True
+        initialise_plugins()
+        log.is_startup = prev
+    error_count = 0
+    try:
+        while True:
+            try:
+                if error_count > 200:
+                    print('More than 200 errors have occured. There may be '
+                          'an issue.\nType \'continue\' to continue else '
+                          'exit')
+                    r = await asyncio.to_thread(input)
+                    if r.strip().lower() == 'continue':
+                        error_count = 0
+                    elif log.unsaved_changes:
+                        await _generate_commands_async('save')
+                        await _generate_commands_async('exit without saving')
+                    else:
+                        raise ProgramExit
+                await prompt_async()
+            except (NodeError, CommandError, InputError, SyntaxError,
+                    APIWarning) as e:
+                error_count += 1
+                _report_error(e)
+            except ProgramExit:
+                break
+            except Exception:
+                if _local.session.tree is not None and log.unsaved_changes:
+                    log.disable_exemptions.append('save')
+                    await _generate_commands_async('save and exit')
+                raise
+    finally:
+        for task in list(_background_tasks):
+            task.cancel()
+
+
+def _report_error(e):
+    """Print an error raised by a command in the same form as api.run."""
+    if isinstance(e, NodeError):
+        print('\nError whilst executing command:', e)
+    elif isinstance(e, CommandError):
+        print('\nError whilst processing command:', e)
+    elif isinstance(e, InputError):
+        print('\nError whilst processing input:', e)
+    elif isinstance(e, SyntaxError):
+        print('\nError whilst parsing command:', e)
+    else:
+        print('API Warning:', e)
+
+
+def background(awaitable):
+    """Run a coroutine as a task on the event loop of api.run_async.
+
+    The task is cancelled when the CLI exits; an error it raises is printed
+    rather than ending the CLI.
+
+    awaitable: the coroutine to run [coroutine]
+
+    return: [asyncio.Task]
+    """
+    task = asyncio.ensure_future(awaitable)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
+
+def _background_done(task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print('\nError in background task:', task.exception())
+
+
 def prompt():
     """Read CLI input."""
+    tree = _local.session.tree
     if tree is None:
         prev = log.disable_all, log.disable_exemptions, log.unsaved_changes
         log.disable_all = True
@@ -697,16 +1700,44 @@ def prompt():
         log.unsaved_changes = False
         print('\nNo data tree - use the \'load\' command to load a tree')
         print(plugin.prompt_string(), end='')
-        r = _generate_commands(input())
+        r = _generate_commands(_local.session.autosave.read_input())
         log.disable_all, log.disable_exemptions, log.unsaved_changes = prev
         print(prev)
     else:
-        if getattr(tree.current_node, '_deleted', False):
+        if any(getattr(node, '_deleted', False)
+               for node in tree.current_node.traversal_depth):
             switch_node(tree.root)
             raise NodeError('current node has been deleted; switched to root')
         print(plugin.display_hook(tree.current_node))
         print(plugin.prompt_string(tree.current_node), end='')
-        r = _generate_commands(input())
+        r = _generate_commands(_local.session.autosave.read_input())
+    plugin.capture_return(r)
+
+
+async def prompt_async():
+    """Read CLI input without blocking the event loop."""
+    tree = _local.session.tree
+    if tree is None:
+        prev = log.disable_all, log.disable_exemptions, log.unsaved_changes
+        log.disable_all = True
+        log.disable_exemptions = ['help', 'load', 'exit', 'reload', 'set']
+        log.unsaved_changes = False
+        print('\nNo data tree - use the \'load\' command to load a tree')
+        print(plugin.prompt_string(), end='', flush=True)
+        r = await _generate_commands_async(await asyncio.to_thread(
+            _local.session.autosave.read_input
+        ))
+        log.disable_all, log.disable_exemptions, log.unsaved_changes = prev
+    else:
+        if any(getattr(node, '_deleted', False)
+               for node in tree.current_node.traversal_depth):
+            switch_node(tree.root)
+            raise NodeError('current node has been deleted; switched to root')
+        print(plugin.display_hook(tree.current_node))
+        print(plugin.prompt_string(tree.current_node), end='', flush=True)
+        r = await _generate_commands_async(await asyncio.to_thread(
+            _local.session.autosave.read_input
+        ))
     plugin.capture_return(r)
     return r
 
@@ -717,7 +1748,8 @@ def _generate_commands(command_str):
     parser = parsers.CLIParser(lexer)
     commands = parser.generate_commands()
     plugin.inspect_commands(commands)
-    print(commands, end='\n\n')
+    if log.interactive:
+        print(commands, end='\n\n')
     command_queue, post_commands = [], []
     command_queue.extend(commands)
     return_values = []
@@ -729,12 +1761,155 @@ def _generate_commands(command_str):
     while post_commands:
         c = post_commands.pop(0)
         return_values.append((c.ID, execute_command(c)))
-    print()
+    if log.interactive:
+        print()
+    _local.session.autosave.maybe_save()
+    _local.session.watcher.maybe_reload()
     return return_values
 
 
+async def _generate_commands_async(command_str):
+    """Generate commands from CLI text, awaiting coroutine commands."""
+    lexer = lexers.CLILexer(command_str)
+    parser = parsers.CLIParser(lexer)
+    commands = parser.generate_commands()
+    plugin.inspect_commands(commands)
+    if log.interactive:
+        print(commands, end='\n\n')
+    command_queue, post_commands = [], []
+    command_queue.extend(commands)
+    return_values = []
+    while command_queue:
+        c = command_queue.pop(0)
+        return_values.append((c.ID, await execute_command_async(c)))
+    plugin.inspect_post_commands(post_commands)
+    while post_commands:
+        c = post_commands.pop(0)
+        return_values.append((c.ID, await execute_command_async(c)))
+    if log.interactive:
+        print()
+    _local.session.autosave.maybe_save()
+    _local.session.watcher.maybe_reload()
+    return return_values
+
+
+class _Replies(io.TextIOBase):
+    """Stand-in for stdin which gives the same reply to every prompt."""
+
+    def __init__(self, reply=None):
+        self.reply = reply
+
+    def readline(self, size=-1):
+        if self.reply is None:
+            return ''  # end of file, so input() raises EOFError
+        return self.reply + '\n'
+
+
+def run_script(lines, *, keep_going=False, answer=None):
+    """Execute CLI lines without prompting or displaying the data tree.
+
+    lines: CLI input lines [list: str]
+    keep_going: [default=False] continue after a line fails
+    answer: [optional] reply given to any confirmation prompt of a
+            command; if None, a command which prompts fails
+
+    Errors are printed to stderr with their line numbers.
+
+    return: exit status, 0 if every line succeeded, else 1 [int]
+    """
+    if _local.session.tree is None:
+        initialise_plugins()
+    prev_interactive, prev_stdin = log.interactive, sys.stdin
+    log.interactive = False
+    sys.stdin = _Replies(answer)
+    status = 0
+    try:
+        for number, line in enumerate(lines, 1):
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            try:
+                _generate_commands(line)
+            except ProgramExit:
+                break
+            except (NodeError, CommandError, InputError, SyntaxError,
+                    APIWarning, EOFError) as e:
+                if isinstance(e, EOFError):
+                    e = 'command needs a reply to a prompt (no answer given)'
+                print(f'Error on line {number}: {e}', file=sys.stderr)
+                status = 1
+                if not keep_going:
+                    break
+    finally:
+        log.interactive, sys.stdin = prev_interactive, prev_stdin
+    return status
+
+
 def execute_command(command):
     """Check command inputs are valid and then execute given command."""
+    if not profiler.enabled:
+        return _execute_command(command)
+    start = perf_counter()
+    try:
+        return _execute_command(command)
+    finally:
+        profiler.record(f'command {command.ID}', perf_counter() - start)
+
+
+async def execute_command_async(command):
+    """Execute a command through its execute_async coroutine."""
+    start = perf_counter()
+    try:
+        inputs = _prepare_inputs(command)
+        return await _call_execute(command, inputs, 'execute_async')
+    finally:
+        if profiler.enabled:
+            profiler.record(f'command {command.ID}', perf_counter() - start)
+
+
+def _execute_command(command):
+    inputs = _prepare_inputs(command)
+    cls = type(command)
+    if (cls.execute is Command.execute
+            and cls.execute_async is not Command.execute_async):
+        # a command with only a coroutine still runs outside run_async
+        return _await_sync(_call_execute(command, inputs, 'execute_async'))
+    return _call_execute(command, inputs)
+
+
+def _await_sync(awaitable):
+    """Wait for a coroutine command outside of api.run_async."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(awaitable)
+    # the loop of this thread is busy running the caller, so the coroutine
+    # needs its own loop in another thread
+    with ThreadPoolExecutor(1) as executor:
+        return executor.submit(
+            _in_session(_local.session, asyncio.run), awaitable
+        ).result()
+
+
+async def to_thread(func, *args, **kw):
+    """Run a function in a worker thread using the caller's session.
+
+    return: the return value of func [any]
+    """
+    return await asyncio.to_thread(
+        _in_session(_local.session, func), *args, **kw
+    )
+
+
+def _in_session(session, func):
+    @wraps(func)
+    def wrapper(*args, **kw):
+        with session:
+            return func(*args, **kw)
+    return wrapper
+
+
+def _prepare_inputs(command):
+    """Fill in default values and run the input handlers of a command."""
     try:
         inputs = command.inputs  # may be an empty dict
     except AttributeError:
@@ -764,6 +1939,10 @@ def execute_command(command):
                     # given is itself None
             if fail or not was_none:
                 test = getattr(command, 'input_handler_'+name)
+                if profiler.enabled:
+                    test = profiler.wrap(
+                        f'input handler {command.ID}.{name}', test
+                    )
                 value = test(value)
                 if (value is None
                       and not getattr(test, 'may_return_none', False)):
@@ -777,10 +1956,14 @@ def execute_command(command):
                 raise CommandError('no default value given for parameter '
                     f'\'{name}\''
                 )
+    return inputs
+
+
+def _call_execute(command, inputs, method='execute'):
     try:
-        return command.execute(**inputs)
+        return getattr(command, method)(**inputs)
     except TypeError as e:
-        if str(e).startswith('execute()'):
+        if str(e).startswith(f'{method}()'):
             # this should only match TypeError arising from the wrong
             # number of inputs given to the command
             raise InputError('not enough or too many inputs given to command '
@@ -804,6 +1987,15 @@ class Command:
         """Execute the command."""
         raise CommandError(f'command \'{self.ID}\' not implemented')
 
+    async def execute_async(self, *args, **kw):
+        """Execute the command from api.run_async.
+
+        By default this calls execute on the event loop. Commands which
+        wait on files or prompts override it so the loop stays free, and
+        a command may define only this coroutine.
+        """
+        return self.execute(*args, **kw)
+
     def disabled(self):
         """Indicate whether a command is disabled in the current context."""
         return False
@@ -818,7 +2010,7 @@ class Command:
                 f'class \'{cls.__name__}\' is not bound to a command name -'
                 ' no ID attribute'
             )
-        registry[' '.join(cls.ID.split())] = cls
+        _registry[' '.join(cls.ID.split())] = cls
         log.new_commands += 1
         startup_message(f'Registered command \'{cls.ID}\'')
 
@@ -834,7 +2026,7 @@ def resolve_command(name):
     return value: Command subclass instance
     """
     try:
-        return registry[name.lower()]()
+        return _local.session.registry[name.lower()]()
     except KeyError:
         raise CommandError(f'unknown command \'{name}\'')
 
@@ -967,7 +2159,7 @@ def resolve_child(indices, node=None, offset=False):
                 new.append(i)
         indices = new
     if node is None:
-        node = tree.current_node
+        node = _local.session.tree.current_node
     for i in indices:
         try:
             node = node.children[i]
@@ -986,8 +2178,9 @@ def compile_command(command_str, name, desc=''):
     desc: [optional] a description to give the command
 
     The .execute method of the CompiledCommand class will call
-    _generate_commands(command_str) so that the string is parsed as if it
-    was read from a CLI input.
+    _generate_commands(command_str), and .execute_async will await
+    _generate_commands_async(command_str), so that the string is parsed as
+    if it was read from a CLI input.
 
     return: dynamically created CompiledCommand class
     """
@@ -998,10 +2191,14 @@ def compile_command(command_str, name, desc=''):
         def execute(self):
             _generate_commands(command_str)
 
+        async def execute_async(self):
+            await _generate_commands_async(command_str)
+
     return CompiledCommand
 
 
 def evaluate_node_reference(ref, *args, offset=True):
+    tree = _local.session.tree
     if tree is None:
         raise CommandError('no data tree for node reference')
     if args:
@@ -1040,6 +2237,11 @@ def evaluate_node_reference(ref, *args, offset=True):
     return node
 
 
+def reference_string(node):
+    """Return the absolute node reference of a node, e.g. '~/eric'."""
+    return '/'.join(['~', *[n.id for n in node.traversal_depth[1:]]])
+
+
 def warning(message):
     """Print a warning or raise an APIWarning.
 
@@ -1175,18 +2377,25 @@ class tests:
         """Test if node is a child reference of the current node."""
         if not is_node(node):
             return False
-        return getattr(node, 'parent', None) == tree.current_node
+        current = _local.session.tree.current_node
+        return getattr(node, 'parent', None) == current
 
     @staticmethod
     def is_forward_reference(node):
         """Test if node is a forward reference of the current node."""
         if not is_node(node):
             return False
-        return tree.current_node in node.parent_list
+        return _local.session.tree.current_node in node.parent_list
 
 
 class Hooks:
-    """Class which must be subclassed to register custom API hooks."""
+    """Class which must be subclassed to register custom API hooks.
+
+    A hook may also be given a '<hook>_batch' variant which takes one list
+    per parameter (and returns a list of results for single hooks). It is
+    used when many nodes or tags are handled at once; if only the batch
+    variant is defined, it is also used for single calls.
+    """
 
     floating_functions = []
     custom_hook_defaults = {}
@@ -1194,9 +2403,18 @@ class Hooks:
     def __init_subclass__(cls):
         """Initialise a subclass and register its valid hooks."""
         cls.is_main_plugin = bool(log.importing_main_plugin)
+        hooks = {}
         for k, v in cls.__dict__.items():
-            if not callable(v):
-                continue
+            if callable(v) and not k.endswith('_batch'):
+                hooks.setdefault(k, v)
+            elif callable(v):
+                name = k[:-len('_batch')]
+                base = cls.__dict__.get(name)
+                if not callable(base):
+                    base = structure.per_item_hook(name, v)
+                base._batch = v
+                hooks[name] = base
+        for k, v in hooks.items():
             if k in _hook_names:
                 if structure._is_single(k) and not log.importing_main_plugin:
                     continue
@@ -1220,6 +2438,11 @@ class Loader:
                 ' no ID attribute'
             )
         loaders[' '.join(cls.ID.split())] = cls
+        for name in ('load', 'save'):
+            if name in cls.__dict__:
+                setattr(cls, name, profiler.instrument(
+                    f'loader {cls.ID}.{name}', cls.__dict__[name]
+                ))
         log.new_loaders += 1
         startup_message(f'Registered loader \'{cls.ID}\'')
 
@@ -1228,3 +2451,22 @@ class Loader:
         """Set the plugin file and initialise plugins."""
         log.plugin_file = file
         reload_plugins()
+
+
+def _session_attribute(name):
+    return property(lambda module: getattr(_local.session, name),
+                    lambda module, value: setattr(_local.session, name, value))
+
+
+class _APIModule(type(sys)):
+    """Module type forwarding per-session names to the current session."""
+
+    tree = _session_attribute('tree')
+    registry = _session_attribute('registry')
+    command_queue = _session_attribute('command_queue')
+    post_commands = _session_attribute('post_commands')
+    autosave = _session_attribute('autosave')
+    watcher = _session_attribute('watcher')
+
+
+sys.modules[__name__].__class__ = _APIModule
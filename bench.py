@@ -0,0 +1,434 @@
+"""Benchmarks for loading, saving, navigating and editing data trees.
+
+Run from the directory containing the tagger package:
+
+    python -m tagger.bench generate wide data.txt [--format json]
+    python -m tagger.bench run [--scale 0.1] [--output results.json]
+                               [--baseline baseline.json]
+    python -m tagger.bench replay commands.txt -d data.txt
+"""
+
+import io
+import os
+import sys
+import json
+import argparse
+import tempfile
+import contextlib
+import tracemalloc
+from time import perf_counter
+from functools import partial
+
+from tagger import api
+from tagger import lexers
+from tagger import parsers
+
+
+SHAPES = {
+    # shape: (default number of nodes, description)
+    'wide': (100000, 'one level of many children'),
+    'deep': (10000, 'a single chain of nested nodes'),
+    'tagged': (10000, 'two levels of nodes with many tags each'),
+    'long': (1000, 'nodes holding long data strings'),
+}
+TAGS_PER_NODE = 20
+LONG_DATA_LENGTH = 10000
+CLI_LINES = [
+    'enter 1',
+    'new tag \'status\' \'draft\'',
+    'edit tag value \'status\' \'final\'',
+    'new data at 1 \'quote\'',
+    'return',
+    'goto ~/1',
+    'what depth; what id',
+]
+
+
+def generate_nodes(shape, size=None):
+    """Generate the nodes of a synthetic tree in depth-first order.
+
+    shape: one of SHAPES [str]
+    size: [optional] number of nodes (default depends on shape) [int]
+
+    return: iterator of (depth, data, tags) for every node below the root
+    """
+    if shape not in SHAPES:
+        raise ValueError(f'unknown shape \'{shape}\'')
+    size = SHAPES[shape][0] if size is None else size
+    if shape == 'wide':
+        for i in range(size):
+            yield 1, f'node {i}', {'index': str(i)}
+    elif shape == 'deep':
+        for i in range(size):
+            yield i + 1, f'level {i}', {'level': str(i)}
+    elif shape == 'tagged':
+        groups = max(1, int(size ** 0.5))
+        for i in range(size):
+            depth = 1 if i % groups == 0 else 2
+            tags = {f'tag {j}': f'value {i} {j}'
+                    for j in range(TAGS_PER_NODE)}
+            yield depth, f'node {i}', tags
+    else:
+        for i in range(size):
+            text = f'text {i} ' * (LONG_DATA_LENGTH // (7 + len(str(i))))
+            yield 1, text.strip(), {}
+
+
+def write_tagger(file, shape, size=None):
+    """Write a synthetic tree to a file in tagger format."""
+    with open(file, 'w') as f:
+        f.write(f'Benchmark {shape}\n`shape={shape}\n')
+        for depth, data, tags in generate_nodes(shape, size):
+            stars = '*' * depth
+            f.write(f'{stars}{data}\n')
+            for k, v in tags.items():
+                f.write(f'{stars}`{k}={v}\n')
+
+
+def write_json(file, shape, size=None):
+    """Write a synthetic tree to a file in the JSON loader's format.
+
+    The document is written iteratively so deep trees can be generated.
+    """
+    dumps = json.dumps
+    with open(file, 'w') as f:
+        f.write('{"data": %s, "tags": %s, "children": ['
+                % (dumps(f'Benchmark {shape}'), dumps({'shape': shape})))
+        open_depth = 0  # depth of the last node whose object is still open
+        first = True
+        for depth, data, tags in generate_nodes(shape, size):
+            if depth > open_depth:
+                if not first:
+                    f.write(', "children": [')
+            else:
+                f.write('}' + ']}' * (open_depth - depth) + ', ')
+            f.write('{"data": %s, "tags": %s' % (dumps(data), dumps(tags)))
+            open_depth, first = depth, False
+        if not first:
+            f.write('}' + ']}' * (open_depth - 1))
+        f.write(']}\n')
+
+
+def _time(func, repeat):
+    """Return the best wall time of several calls to func."""
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _load_json(file):
+    api.tree = api.Tree(api.loaders['json']().load(file))
+
+
+def _reference_to(node):
+    return ['~', *[n.id for n in node.traversal_depth[1:]]]
+
+
+def _deepest_last(root):
+    node = root
+    while node.children:
+        node = node.children[-1]
+    return node
+
+
+def run_benchmarks(scale=1.0, repeat=3, only=None, directory=None):
+    """Run every benchmark and return the results.
+
+    scale: multiplier applied to the default size of each shape [float]
+    repeat: number of runs; the best time is kept [int]
+    only: [optional] run only benchmarks whose name contains one of these
+          strings [list: str]
+    directory: [optional] directory for generated files [str <dir>]
+
+    return: benchmark name -> {'seconds': float} or {'error': str} [dict]
+    """
+    results = {}
+
+    def bench(name, func, n=1):
+        if only and not any(part in name for part in only):
+            return
+        try:
+            seconds = _time(func, repeat)
+        except Exception as e:
+            results[name] = {'error': f'{type(e).__name__}: {e}'[:200]}
+        else:
+            results[name] = {'seconds': seconds, 'operations': n}
+
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        for shape, (size, _) in SHAPES.items():
+            size = max(1, int(size * scale))
+            if shape == 'deep':
+                # the tagger parser recurses once for each level, past the
+                # recursion limit, so this tree is streamed from JSON
+                source = os.path.join(tmp, f'{shape}.json')
+                write_json(source, shape, size)
+                name = f'load/json/{shape}'
+                build = partial(_load_json, source)
+            else:
+                source = os.path.join(tmp, f'{shape}.txt')
+                write_tagger(source, shape, size)
+                with open(source) as f:
+                    text = f.read()
+                name = f'make_tree/{shape}'
+                build = partial(api.make_tree, source=text)
+
+            bench(name, build)
+            result = results.get(name)
+            if result is None:  # not selected, but needed by the others
+                build()
+            elif 'error' in result:
+                raise RuntimeError(f'cannot build the {shape} tree: '
+                                   f'{result["error"]}')
+            for loader in ('default', 'json'):
+                output = os.path.join(tmp, f'{shape}.{loader}')
+                bench(f'save/{loader}/{shape}',
+                      lambda: api.loaders[loader]().save(output))
+
+            ref = _reference_to(_deepest_last(api.tree.root))
+            bench(f'evaluate_node_reference/{shape}',
+                  lambda: [api.evaluate_node_reference(list(ref))
+                           for _ in range(100)], 100)
+
+            nodes = api.tree.root.children[:1000]
+
+            def edit():
+                for i, node in enumerate(nodes):
+                    api.edit_data(f'edited {i}', node=node)
+                    api.new_tag('_id', f'edited_{i}', node=node)
+                    api.remove_tag('_id', node=node)
+            bench(f'edits/{shape}', edit, len(nodes) * 3)
+
+        api.make_tree(source='Benchmark cli\n*a\n**b\n*c\n')
+        api.tree.current_node = api.tree.root
+        lines = CLI_LINES * 200
+
+        def parse():
+            for line in lines:
+                parsers.CLIParser(lexers.CLILexer(line)).generate_commands()
+        bench('cli_parse', parse, len(lines))
+    return results
+
+
+class _Discard(io.TextIOBase):
+    """Stand-in for stdout which discards everything written to it."""
+
+    def write(self, s):
+        return len(s)
+
+
+def _percentile(values, percent):
+    """Return the nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1,
+                      int(round(percent / 100 * len(values))) - 1))
+    return values[rank]
+
+
+def _latency_summary(values):
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'p50': _percentile(values, 50),
+        'p90': _percentile(values, 90),
+        'p99': _percentile(values, 99),
+        'max': values[-1] if values else None,
+    }
+
+
+def replay(lines, answer='yes', trace_memory=False):
+    """Feed CLI lines through the command pipeline and measure them.
+
+    lines: CLI input lines, as typed at the prompt [list: str]
+    answer: reply given to any input() prompt by a command [str]
+    trace_memory: [optional] measure memory with tracemalloc, which slows
+                  execution down [bool]
+
+    Each line is lexed, parsed and executed by api._generate_commands with
+    output discarded. Errors are counted and do not stop the replay.
+
+    return: summary of latencies (seconds), throughput and memory [dict]
+    """
+    lines = [line for line in lines
+             if line.strip() and not line.lstrip().startswith('#')]
+    latencies, by_command, errors = [], {}, 0
+    stdin = sys.stdin
+    sys.stdin = api._Replies(answer)
+    if trace_memory:
+        tracemalloc.start()
+    start_memory = (tracemalloc.get_traced_memory()[0] if trace_memory
+                    else _max_rss())
+    start = perf_counter()
+    try:
+        with contextlib.redirect_stdout(_Discard()):
+            for line in lines:
+                line_start = perf_counter()
+                try:
+                    r = api._generate_commands(line)
+                except (api.NodeError, api.CommandError, api.InputError,
+                        SyntaxError, api.APIWarning):
+                    errors += 1
+                    r = None
+                except api.ProgramExit:
+                    break
+                elapsed = perf_counter() - line_start
+                latencies.append(elapsed)
+                name = ('; '.join(ID for ID, _ in r) if r
+                        else '(error)' if r is None else '(empty)')
+                by_command.setdefault(name, []).append(elapsed)
+        total = perf_counter() - start
+        if trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            memory = {'growth': current - start_memory, 'peak': peak,
+                      'unit': 'bytes (tracemalloc)'}
+        else:
+            end_memory = _max_rss()
+            memory = {'growth': (None if end_memory is None
+                                 else end_memory - start_memory),
+                      'unit': 'kilobytes (max RSS)'}
+    finally:
+        sys.stdin = stdin
+        if trace_memory:
+            tracemalloc.stop()
+    return {
+        'lines': len(latencies),
+        'errors': errors,
+        'seconds': total,
+        'lines_per_second': len(latencies) / total if total else None,
+        'latency': _latency_summary(latencies),
+        'by_command': {name: _latency_summary(values)
+                       for name, values in by_command.items()},
+        'memory': memory,
+    }
+
+
+def _max_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def compare(results, baseline, tolerance=1.2):
+    """Compare results with a baseline.
+
+    tolerance: ratio of result to baseline time that counts as a
+               regression [float]
+
+    return: lines describing each benchmark, and the regressed names
+            [tuple: list: str, list: str]
+    """
+    lines, regressions = [], []
+    for name, result in results.items():
+        base = baseline.get(name, {})
+        if 'seconds' not in result or 'seconds' not in base:
+            lines.append(f'{name}: {result.get("error", "no baseline")}')
+            continue
+        ratio = result['seconds'] / base['seconds'] if base['seconds'] else 1
+        flag = ''
+        if ratio > tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        lines.append(f'{name}: {result["seconds"]:.4f}s '
+                     f'(baseline {base["seconds"]:.4f}s, x{ratio:.2f}){flag}')
+    return lines, regressions
+
+
+def _setup():
+    """Set up the API quietly so plugins do not print during benchmarks."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        api.manual_setup()
+        api.initialise_plugins()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m tagger.bench',
+        description='benchmark tagger data tree operations'
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+    generate = commands.add_parser('generate', help='write a synthetic tree')
+    generate.add_argument('shape', choices=list(SHAPES))
+    generate.add_argument('file')
+    generate.add_argument('--format', choices=['tagger', 'json'],
+                          default='tagger')
+    generate.add_argument('--size', type=int, default=None,
+                          help='number of nodes')
+    run = commands.add_parser('run', help='run the benchmarks')
+    run.add_argument('--scale', type=float, default=1.0,
+                     help='multiplier for the default tree sizes')
+    run.add_argument('--repeat', type=int, default=3)
+    run.add_argument('--only', nargs='*', default=None, metavar='NAME')
+    run.add_argument('--output', metavar='FILE',
+                     help='write the results as JSON')
+    run.add_argument('--baseline', metavar='FILE',
+                     help='compare against stored results')
+    run.add_argument('--tolerance', type=float, default=1.2)
+    replay_ = commands.add_parser('replay',
+                                  help='replay a recorded command log')
+    replay_.add_argument('log', help='file with one CLI line per line')
+    replay_.add_argument('-d', '--data', required=True, metavar='FILE',
+                         help='data source to load before replaying')
+    replay_.add_argument('--answer', default='yes',
+                         help='reply to give to confirmation prompts')
+    replay_.add_argument('--trace-memory', action='store_true',
+                         help='measure memory with tracemalloc (slower)')
+    replay_.add_argument('--output', metavar='FILE',
+                         help='write the summary as JSON')
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        writer = write_json if args.format == 'json' else write_tagger
+        writer(args.file, args.shape, args.size)
+        return 0
+
+    if args.command == 'replay':
+        with contextlib.redirect_stdout(io.StringIO()):
+            api.manual_setup(data_source=args.data)
+            api.make_tree()
+        with open(args.log) as f:
+            summary = replay(f.read().splitlines(), args.answer,
+                             args.trace_memory)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(summary, f, indent=2)
+        latency = summary['latency']
+        print('{} lines in {:.3f}s ({:.1f} lines/s), {} errors'.format(
+            summary['lines'], summary['seconds'],
+            summary['lines_per_second'] or 0, summary['errors']
+        ))
+        if latency['count']:
+            print('latency p50 {:.3f}ms, p90 {:.3f}ms, p99 {:.3f}ms, '
+                  'max {:.3f}ms'.format(*[latency[k] * 1000 for k in
+                                          ('p50', 'p90', 'p99', 'max')]))
+        print('memory growth: {} {}'.format(summary['memory']['growth'],
+                                            summary['memory']['unit']))
+        return 0
+
+    _setup()
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = run_benchmarks(args.scale, args.repeat, args.only)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        lines, regressions = compare(results, baseline, args.tolerance)
+        print('\n'.join(lines))
+        return 1 if regressions else 0
+    for name, result in results.items():
+        if 'seconds' in result:
+            print(f'{name}: {result["seconds"]:.4f}s')
+        else:
+            print(f'{name}: {result["error"]}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
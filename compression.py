@@ -0,0 +1,71 @@
+"""Read and write data files compressed with gzip, bzip2 or xz.
+
+Compressed sources are recognised by their first bytes, whatever their
+names, and decompressed as they are read. Output is compressed if asked
+for, or if the file name ends with the suffix of a compression.
+"""
+
+import bz2
+import gzip
+import lzma
+
+COMPRESSIONS = {  # name -> (magic bytes, suffix, module)
+    'gzip': (b'\x1f\x8b', '.gz', gzip),
+    'bz2': (b'BZh', '.bz2', bz2),
+    'xz': (b'\xfd7zXZ\x00', '.xz', lzma),
+}
+_MAGIC_LENGTH = max(len(magic) for magic, *_ in COMPRESSIONS.values())
+
+
+def detect(file):
+    """Return the name of the compression of a file, or None.
+
+    file: path of the file [str]
+
+    return: [str/None]
+    """
+    with open(file, 'rb') as f:
+        start = f.read(_MAGIC_LENGTH)
+    for name, (magic, *_) in COMPRESSIONS.items():
+        if start.startswith(magic):
+            return name
+    return None
+
+
+def open_source(file, mode='r'):
+    """Open a data file for reading, decompressing it if it is compressed.
+
+    file: path of the file [str]
+    mode: [default='r'] 'r' for text or 'rb' for bytes [str]
+
+    return: file object
+    """
+    compression = detect(file)
+    if compression is None:
+        return open(file, mode)
+    module = COMPRESSIONS[compression][2]
+    return module.open(file, 'rt' if mode == 'r' else mode)
+
+
+def open_output(file, compression=None, mode='w'):
+    """Open a data file for writing, compressing what is written to it.
+
+    file: path of the file [str]
+    compression: [optional] 'gzip', 'bz2' or 'xz'; by default the one
+                 whose suffix the file name ends with, if any [str]
+    mode: [default='w'] 'w' for text or 'wb' for bytes [str]
+
+    return: file object
+    """
+    if compression is None:
+        compression = next((name for name, (_, suffix, _) in
+                            COMPRESSIONS.items() if file.endswith(suffix)),
+                           None)
+        if compression is None:
+            return open(file, mode)
+    try:
+        module = COMPRESSIONS[compression][2]
+    except KeyError:
+        raise ValueError(f'unknown compression \'{compression}\' (expected '
+                         f'{", ".join(COMPRESSIONS)})')
+    return module.open(file, 'wt' if mode == 'w' else mode)
@@ -0,0 +1,178 @@
+"""Parse the top-level sections of a data file only when they are used.
+
+A first pass over the file finds where each top-level node starts and
+parses only that node and its tags. The index is saved next to the data
+file (FILE.idx) so that opening the file again does not read it. The
+rest of a section is parsed the first time the children of its node are
+used, for example by 'enter', 'goto' or a node reference.
+"""
+
+import os
+import json
+import locale
+import threading
+from functools import partial
+from contextlib import suppress
+
+from tagger import api
+from tagger import parsers
+from tagger import compression
+from tagger import structure
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.idx'
+
+
+class LazySource:
+    """A data file whose top-level sections are parsed on demand.
+
+    Sections are read by byte offset, so the file must not change while
+    any of them is still unparsed.
+    """
+
+    def __init__(self, file, index):
+        self.file = file
+        self.stat = (index['size'], index['mtime_ns'])
+        self.encoding = index['encoding']
+        self.lock = threading.RLock()
+        self.loading = set()  # nodes whose sections are being parsed
+
+    def read(self, offset, length):
+        """Read part of the file, checking that it has not changed."""
+        with open(self.file, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if (stat.st_size, stat.st_mtime_ns) != self.stat:
+                raise api.CommandError(
+                    f'\'{self.file}\' has changed since it was opened; load '
+                    'it again to use its unparsed sections'
+                )
+            f.seek(offset)
+            return _decode(f.read(length), self.encoding)
+
+    def load(self, section, node):
+        """Parse a node's section and give the node its children.
+
+        section: offset, length and first line of the section [list]
+        node: [structure.LazyNode]
+        """
+        with self.lock:
+            if node.loaded or node in self.loading:
+                return  # loaded by another thread, or used while parsing
+            self.loading.add(node)
+            try:
+                offset, length, line = section
+                patterns = parsers.parse_patterns(self.read(offset, length),
+                                                  line)
+                session = api.current_session()
+                # a private session: parsing is not an edit of the tree, and
+                # a thread reading the tree must not need the write lock
+                with api.Session(session.tree, log_values=dict(
+                        session.log_values)):
+                    children = parsers.construct_children(patterns, node)
+                node.children.extend(children)
+                node._load = None
+            finally:
+                self.loading.discard(node)
+
+
+def open_tree(file):
+    """Create a data tree whose top-level sections are parsed on demand.
+
+    The index of the file is read from FILE.idx if it is up to date,
+    otherwise it is built and saved there.
+
+    file: path of the data file [str]
+
+    return: data tree [structure.Root]
+    """
+    file = os.path.abspath(file)
+    if compression.detect(file) is not None:
+        raise api.CommandError(f'\'{file}\' is compressed; its sections '
+                               'cannot be read by offset')
+    index = read_index(file)
+    if index is None:
+        index = build_index(file)
+        write_index(file, index)
+    source = LazySource(file, index)
+    sections = index['sections']
+    heads = [index['head'], *(head for *_, head in sections)]
+    root = parsers.construct_tree(parsers.PatternStream(heads),
+                                  node_type=structure.LazyNode)
+    if sections:
+        nodes = root.children[-len(sections):]
+        for node, (*section, _) in zip(nodes, sections):
+            node._load = partial(source.load, section)
+    root.lazy_source = source
+    return root
+
+
+def reads_from(root, file):
+    """Return whether unparsed sections of a tree are read from a file.
+
+    Such a tree must be materialized (see api.materialize) before it is
+    written over the file.
+
+    root: [NodeType]
+    file: path of the file [str]
+
+    return: [bool]
+    """
+    source = getattr(root, 'lazy_source', None)
+    return source is not None and source.file == os.path.abspath(file)
+
+
+def build_index(file):
+    """Find and parse the first node and tags of every top-level section.
+
+    return: index, as saved to FILE.idx [dict]
+    """
+    encoding = locale.getpreferredencoding(False)
+    with open(file, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        data = f.read()
+    starts = [*parsers.section_starts(data), len(data)]
+    head = parsers.parse_patterns(_decode(data[:starts[0]], encoding))
+    sections = []
+    line = 1 + data.count(b'\n', 0, starts[0])
+    for start, end in zip(starts, starts[1:]):
+        text = _decode(data[start:end], encoding)
+        sections.append([start, end - start, line,
+                         parsers.parse_head(text, line)])
+        line += data.count(b'\n', start, end)
+    return {'version': INDEX_VERSION, 'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns, 'encoding': encoding,
+            'head': head, 'sections': sections}
+
+
+def read_index(file):
+    """Return the saved index of a file, or None if it is missing or stale."""
+    try:
+        with open(file + INDEX_SUFFIX, 'r') as f:
+            index = json.load(f)
+        stat = os.stat(file)
+    except (OSError, ValueError):
+        return None
+    if (not isinstance(index, dict)
+            or index.get('version') != INDEX_VERSION
+            or index.get('size') != stat.st_size
+            or index.get('mtime_ns') != stat.st_mtime_ns):
+        return None
+    return index
+
+
+def write_index(file, index):
+    """Save an index next to its file, if the directory is writable."""
+    temp = f'{file}{INDEX_SUFFIX}.{os.getpid()}.tmp'
+    try:
+        with open(temp, 'w') as f:
+            json.dump(index, f)
+        os.replace(temp, file + INDEX_SUFFIX)
+    except OSError:
+        with suppress(OSError):
+            os.remove(temp)
+
+
+def _decode(data, encoding):
+    """Decode bytes as reading the file in text mode would."""
+    text = data.decode(encoding)
+    return text.replace('\r\n', '\n').replace('\r', '\n')
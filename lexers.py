@@ -74,11 +74,12 @@ _single_char_conversion_CLI = {
 class LexerBase:
     """Base class to perform essential lexer functions."""
 
-    def __init__(self, text):
+    def __init__(self, text, line=1):
         self.data = text
         self.pos = 0
         self.queued_tokens = []
-        self.line = 1
+        self.first_line = line  # line number of the start of the text
+        self.line = line
         self.col = 0
         self.current = self.data[self.pos] if self.data else ''
 
@@ -95,7 +96,7 @@ class LexerBase:
         return self.generate_token()
 
     def reset(self):
-        self.__init__(self.data)
+        self.__init__(self.data, self.first_line)
 
     def advance(self, n=1):
         """Move the pointer forward to the next character(s)."""
@@ -1,7 +1,10 @@
 """Parsers for data input, CLI and command signatures."""
 
+import os
 import sys
 sys.setrecursionlimit(200)
+from itertools import chain, islice
+from concurrent.futures import ProcessPoolExecutor
 
 from tagger import lexers
 from tagger import structure
@@ -408,7 +411,8 @@ class Buffer:
             raise StopIteration
 
 
-def _recursive_construct(parser, _depth, _parent, _top_level=False):
+def _recursive_construct(parser, _depth, _parent, _top_level=False,
+                         _node_type=structure.Node):
     """Construct data tree using recursion."""
     plugin = api.plugin
     lookahead = parser.lookahead(1)
@@ -433,36 +437,367 @@ def _recursive_construct(parser, _depth, _parent, _top_level=False):
                     current.data, current.value, node=children[-1], create=True
                 )
             else:
-                data = plugin.pre_node_creation_hook(
-                    current.data, _depth,
-                    parent_list
-                )
-                node = structure.Node(data, _depth, _parent)
+                data = current.data
+                if not plugin.elided('pre_node_creation_hook'):
+                    data = plugin.pre_node_creation_hook(
+                        data, _depth, parent_list
+                    )
+                node = _node_type(data, _depth, _parent)
                 children.append(node)
         elif diff == 1:
             try:
                 target = _parent if _top_level else children[-1]
-                target.children.extend(
-                    _recursive_construct(parser, _depth + 1, target)
-                )
+                target.children.extend(_recursive_construct(
+                    parser, _depth + 1, target, _node_type=_node_type
+                ))
             except IndexError:
                 parser.obj.raise_error('no parent to add deeper level to')
         else:
             break
         lookahead = parser.lookahead(1)
-    for c in children:
-        plugin.post_node_creation_hook(c)
+    if children and not plugin.elided('post_node_creation_hook'):
+        plugin.call_batch('post_node_creation_hook', children)
     return children
 
 
-def construct_tree(parser):
+PARALLEL_THRESHOLD = 1 << 23  # size of source parsed in parallel by default
+_TEXT, _NODE, _TAG = range(3)
+
+
+def parse_tree(source, workers=None):
+    """Construct a data tree from text in the tagger format.
+
+    source: the text to parse [str]
+    workers: [optional] number of processes that lex and parse top-level
+             sections of the source; by default one per CPU if the source
+             is at least PARALLEL_THRESHOLD characters long, otherwise the
+             source is parsed in this process
+
+    return: data tree [structure.Root]
+    """
+    if workers is None:
+        workers = 1
+        if len(source) >= PARALLEL_THRESHOLD:
+            workers = os.cpu_count() or 1
+    if workers > 1:
+        sections = split_sections(source, workers * 4)
+        if len(sections) > 1:
+            with ProcessPoolExecutor(min(workers, len(sections))) as pool:
+                chunks = pool.map(parse_patterns, *zip(*sections))
+                return construct_tree(PatternStream(chunks))
+    return construct_tree(InputPatternParser(lexers.InputLexer(source)))
+
+
+def split_sections(source, n):
+    """Split a source into about n sections at top-level nodes.
+
+    A section boundary is a line starting with a single '*' that is not
+    followed by a tag, where the previous line does not end with a line
+    continuation (an odd number of backslashes).
+
+    return: each section and the line number it starts at
+            [list: tuple: str, int]
+    """
+    size = max(1, len(source) // n)
+    sections = []
+    start, line = 0, 1
+    while True:
+        i = source.find('\n*', start + size)
+        while i != -1 and not _is_section_start(source, i):
+            i = source.find('\n*', i + 1)
+        if i == -1:
+            break
+        sections.append((source[start:i + 1], line))
+        line += source.count('\n', start, i + 1)
+        start = i + 1
+    sections.append((source[start:], line))
+    return sections
+
+
+def top_level_sections(source):
+    """Split a source into its head and the text of each top-level node.
+
+    The head is the title and the root's tags; each section is a
+    top-level node with its tags and descendants.
+
+    return: the head, and each section with the line number it starts at
+            [tuple: str, list: tuple: str, int]
+    """
+    starts = [*section_starts(source), len(source)]
+    head = source[:starts[0]]
+    line = 1 + head.count('\n')
+    sections = []
+    for start, end in zip(starts, starts[1:]):
+        text = source[start:end]
+        sections.append((text, line))
+        line += text.count('\n')
+    return head, sections
+
+
+def section_starts(source, depth=1, start=0, end=None):
+    """Find where each section of a source at a depth starts.
+
+    A section is a node at the depth with its tags and descendants.
+
+    source: the source, or its encoded bytes [str/bytes]
+    depth: [default=1] depth of the nodes starting the sections [int]
+    start, end: [optional] part of the source to search [int]
+
+    return: index of the first character of each section after the first
+            [iterator: int]
+    """
+    newline = '\n' + '*' * depth
+    if isinstance(source, bytes):
+        newline = newline.encode()
+    if end is None:
+        end = len(source)
+    i = source.find(newline, start, end)
+    while i != -1:
+        if _is_section_start(source, i, depth):
+            yield i + 1
+        i = source.find(newline, i + 1, end)
+
+
+def _is_section_start(source, i, depth=1):
+    if isinstance(source, bytes):
+        stops, backslash = (b'*', b'`', b'\n', b''), b'\\'
+    else:
+        stops, backslash = ('*', '`', '\n', ''), '\\'
+    if source[i + depth + 1:i + depth + 2] in stops:
+        return False  # a deeper node, a tag or no node
+    backslashes = 0
+    while i - backslashes > 0 and (source[i - backslashes - 1:i - backslashes]
+                                   == backslash):
+        backslashes += 1
+    return backslashes % 2 == 0
+
+
+def parse_patterns(text, line=1):
+    """Lex and parse a section of a source into compact patterns.
+
+    text: the section [str]
+    line: [default=1] line number of the start of the section [int]
+
+    return: (kind, data, value, depth, line, column) for each pattern
+            [list: tuple]
+    """
+    return list(_generate_patterns(text, line))
+
+
+def parse_head(text, line=1):
+    """Lex and parse only the first node of a section and its tags.
+
+    The rest of the section is not lexed.
+
+    return: patterns in the form given by parse_patterns [list: tuple]
+    """
+    patterns = _generate_patterns(text, line)
+    head = [next(patterns)]
+    for pattern in patterns:
+        if pattern[0] != _TAG or pattern[3] != head[0][3]:
+            break
+        head.append(pattern)
+    return head
+
+
+def parse_subtree(source, path):
+    """Construct a data tree holding one subtree of a source.
+
+    Sections before the subtree's are skipped by the star markers at the
+    start of their lines; only the first node and tags of a section are
+    parsed, to match its ID. The subtree's ancestors are kept with their
+    tags but no other children, so its nodes have the depths and IDs they
+    have in the full tree. Hooks are called for the ancestors and the
+    subtree only.
+
+    source: the text to parse [str]
+    path: absolute node reference of the subtree's node, made of IDs and
+          indices, e.g. '~/mr_birling/2'; IDs are matched against the
+          data as written in the source, before any hook [str]
+
+    return: data tree [structure.Root]
+    """
+    steps = _reference_steps(path)
+    start, end = next(section_starts(source), len(source)), len(source)
+    chunks = [parse_patterns(source[:start])]
+    line, counted = 1, 0
+    for depth, step in enumerate(steps, 1):
+        start, end = _find_section(source, start, end, depth, step)
+        line += source.count('\n', counted, start)
+        counted = start
+        if depth == len(steps):
+            chunks.append(parse_patterns(source[start:end], line))
+            break
+        children = next(section_starts(source, depth + 1, start, end), end)
+        chunks.append(parse_head(source[start:children], line))
+        start = children
+    return construct_tree(PatternStream(chunks))
+
+
+def _reference_steps(path):
+    """Split an absolute node reference into IDs and 1-based indices."""
+    parts = path.strip().split('/')
+    if parts[0] == '~':
+        del parts[0]
+    if not parts or not all(parts) or '..' in parts or '~' in parts:
+        raise api.CommandError(f'invalid node reference \'{path}\'')
+    steps = []
+    for part in parts:
+        if part.lstrip('-').isdigit():
+            if int(part) == 0:
+                raise api.CommandError('node index 0 exceeds range')
+            steps.append(int(part))
+        else:
+            steps.append(part)
+    return steps
+
+
+def _find_section(source, start, end, depth, step):
+    """Find the section of the child of a node matching an ID or index.
+
+    start, end: the part of the source holding the node's children,
+                starting with the first of them [int]
+
+    return: start and end of the child's section [tuple: int, int]
+    """
+    if start >= end:
+        raise api.CommandError(f'no node with ID {step}' if isinstance(
+            step, str) else f'node index {step} exceeds range')
+    starts = section_starts(source, depth, start, end)
+    if isinstance(step, int):
+        if step > 0:
+            sections, index = chain([start], starts, [end]), step - 1
+        else:
+            sections = [start, *starts, end]
+            index = len(sections) - 1 + step
+        bounds = tuple(islice(sections, max(index, 0), index + 2))
+        if index < 0 or len(bounds) < 2:
+            raise api.CommandError(f'node index {step} exceeds range')
+        return bounds
+    section = start
+    while section < end:
+        following = next(starts, end)
+        children = next(section_starts(source, depth + 1, section,
+                                       following), following)
+        text = source[section:children]
+        try:
+            patterns = parse_head(text)
+        except SyntaxError:
+            # parse again to report the error at its line in the source
+            parse_head(text, 1 + source.count('\n', 0, section))
+            raise
+        tags = {p[1]: p[2] for p in reversed(patterns[1:])}
+        if patterns[0][0] == _NODE and structure.make_id(
+                patterns[0][1], tags) == step:
+            return section, following
+        section = following
+    raise api.CommandError(f'no node with ID {step}')
+
+
+def _generate_patterns(text, line):
+    parser = InputPatternParser(lexers.InputLexer(text, line))
+    lexer = parser.lexer
+    while True:
+        line, col = lexer.line, lexer.col
+        pattern = parser.generate_pattern()
+        if pattern is None:
+            return
+        if isinstance(pattern, structure.TagPattern):
+            yield (_TAG, pattern.data, pattern.value, pattern.depth, line,
+                   col)
+        elif isinstance(pattern, structure.NodePattern):
+            yield (_NODE, pattern.data, None, pattern.depth, line, col)
+        else:
+            yield (_TEXT, pattern.data, None, None, line, col)
+
+
+class PatternStream:
+    """Produce patterns from the output of parse_patterns, in order.
+
+    Used by construct_tree in place of an InputPatternParser; errors are
+    reported at the line of the pattern read most recently.
+    """
+
+    def __init__(self, chunks):
+        self._patterns = (p for chunk in chunks for p in chunk)
+        self.line, self.col, self.value = 1, 0, ''
+
+    def __next__(self):
+        try:
+            kind, data, value, depth, self.line, self.col = next(
+                self._patterns
+            )
+        except StopIteration:
+            return None  # like InputPatternParser at the end of the input
+        self.value = data
+        if kind == _NODE:
+            return structure.NodePattern(data, depth)
+        if kind == _TAG:
+            return structure.TagPattern(data, value, depth)
+        return structure.TextPattern(data)
+
+    def raise_error(self, msg, error=None):
+        error = error or SyntaxError
+        raise error('{} at {}.{}\ntoken: {}'.format(
+            msg.rstrip(' '), self.line, self.col, self.value or ''
+        ))
+
+
+def construct_tree(parser, node_type=structure.Node):
     """Construct a data tree using a parser's output.
 
-    parser: [InputPatternParser]
+    parser: [InputPatternParser/PatternStream]
+    node_type: [default=structure.Node] class of the nodes below the root
 
     return: data tree [structure.Root]
     """
-    parser = Buffer(parser)
+    with api.batch(rollback=False):
+        return _construct_tree(Buffer(parser), node_type)
+
+
+def construct_children(patterns, node):
+    """Construct the descendants of a node from the patterns of its section.
+
+    patterns: output of parse_patterns for the section, starting with the
+              node and its tags, which are skipped [list: tuple]
+    node: the node to construct the children of [NodeType]
+
+    return: the node's children [list: Node]
+    """
+    patterns = iter(patterns)
+    next(patterns)
+    parser = Buffer(PatternStream([patterns]))
+    while (isinstance(parser.lookahead(1), structure.TagPattern)
+           and parser.lookahead(1).depth == node.depth):
+        next(parser)
+    return _construct_below(parser, node)
+
+
+def construct_below(patterns, node):
+    """Construct the descendants of a node from patterns of its children.
+
+    patterns: output of parse_patterns, starting with the first child and
+              with depths counted from the root of the tree [list: tuple]
+    node: the node to construct the children of [NodeType]
+
+    return: the node's children [list: Node]
+    """
+    return _construct_below(Buffer(PatternStream([patterns])), node)
+
+
+def _construct_below(parser, node):
+    with api.batch(rollback=False):
+        children = _recursive_construct(parser, node.depth + 1, node)
+        extra = parser.lookahead(1)
+        if extra is not None:  # a pattern shallower than the node's children
+            next(parser)
+            if isinstance(extra, structure.TagPattern):
+                parser.obj.raise_error('no data point to tag')
+            parser.obj.raise_error('data point is not part of the section')
+    return children
+
+
+def _construct_tree(parser, node_type):
     title = next(parser)
     if title is None:
         api.warning('no tree title given, defaulting to Tree')
@@ -481,6 +816,6 @@ def construct_tree(parser):
         api.initialise_plugins()  # no config tag found
 
     root.children.extend(_recursive_construct(
-        parser, _depth=0, _parent=root, _top_level=True
+        parser, _depth=0, _parent=root, _top_level=True, _node_type=node_type
     ))
     return root
@@ -1,10 +1,12 @@
 """Plugin for API execution hooks and custom commands."""
 
 import os
+import inspect
 
 from tagger import api
 from tagger import lexers
 from tagger import parsers
+from tagger.compression import COMPRESSIONS, detect as detect_compression
 
 
 class Hooks(api.Hooks):
@@ -193,6 +195,17 @@ class Hooks(api.Hooks):
         """
         pass
 
+    def change_hook(nodes):
+        """Inspect nodes after they have been changed by API functions.
+
+        nodes: the changed nodes [list: Node]
+               (one node per edit, or every node changed in an
+                api.batch() block when it is committed)
+
+        return value: None
+        """
+        pass
+
 
 class ExitCommand(api.Command):
     """Command to exit the program."""
@@ -227,11 +240,15 @@ class SaveCommand(api.Command):
     """Command to save data tree to output file."""
 
     ID = 'save'
-    signature = '[as STRING=name|<current>] <and exit> [using STRING=loader]'
-    defaults = {'name': None, 'loader': 'default'}
-    description = 'save the data tree to a file'
-
-    def execute(self, name, current, and_exit, loader):
+    signature = ('[as STRING=name|<current>] <and exit> [using STRING=loader]'
+                 ' <compact> [compressed STRING=compression]')
+    defaults = {'name': None, 'loader': 'default', 'compression': None}
+    description = ('save the data tree to a file, compressed with gzip, bz2 '
+                   'or xz if asked for or if its name ends with .gz, .bz2 or '
+                   '.xz')
+
+    def execute(self, name, current, and_exit, loader, compact,
+                compression):
         cwd = os.path.split(api.log.data_source)[0]
         if name is None and not current:
             file = 'output.txt'
@@ -245,6 +262,7 @@ class SaveCommand(api.Command):
         else:
             if current:
                 name = os.path.basename(api.log.data_source)
+            api.check_save_target(os.path.join(cwd, name))
             if name in os.listdir(cwd):
                 print('File already exists - do you want to overwrite?')
                 r = input('Type \'yes\' to overwrite\n').strip().lower()
@@ -258,13 +276,39 @@ class SaveCommand(api.Command):
             raise api.CommandError(f'no loader \'{loader}\'')
         if not hasattr(loader, 'save'):
             raise api.CommandError('loader has no save method')
-        loader.save(file)
+        options = {}
+        parameters = inspect.signature(loader.save).parameters
+        if compact:
+            if 'compact' not in parameters:
+                raise api.CommandError('loader cannot save compact output')
+            options['compact'] = True
+        if compression is not None:
+            if 'compression' not in parameters:
+                raise api.CommandError('loader cannot compress its output')
+            if compression not in COMPRESSIONS:
+                raise api.CommandError(
+                    f'unknown compression \'{compression}\' (expected '
+                    f'{", ".join(COMPRESSIONS)})'
+                )
+            options['compression'] = compression
+        elif current and 'compression' in parameters and os.path.exists(file):
+            options['compression'] = detect_compression(file)
+            # the source's compression is kept
+        api.materialize()  # the file may be the source of unparsed nodes
+        loader.save(file, **options)
         print('Saved to {}'.format(file))
         api.log.unsaved_changes = False
+        if api.watcher.enabled and file == api.watcher.file:
+            api.watcher.remember()  # not an edit made elsewhere
 
         if and_exit:
             api.manual_execute(ExitCommand(), {})
 
+    async def execute_async(self, **inputs):
+        # the prompt and the write block, so the event loop of
+        # api.run_async is left free while they wait
+        return await api.to_thread(self.execute, **inputs)
+
     def input_handler_loader(self, i):
         return ' '.join(i.split())  # remove double whitespace
 
@@ -341,20 +385,26 @@ class LoadCommand(api.Command):
     """Command to find a loader to manually load a data tree."""
 
     ID = 'load'
-    signature = 'STRING=file [using STRING=loader]'
-    description = 'find a loader command to manually load a data tree'
-    defaults = {'loader': 'default'}
+    signature = 'STRING=file [at STRING=path] [using STRING=loader]'
+    description = ('find a loader command to manually load a data tree, or '
+                   'only the subtree at a node reference')
+    defaults = {'loader': 'default', 'path': None}
 
     def disabled(self):
         return api.tree is not None
 
-    def execute(self, file, loader):
+    def execute(self, file, path, loader):
         try:
             loader = api.loaders[loader]()
         except KeyError:
             raise api.CommandError(f'no loader \'{loader}\'')
         if not hasattr(loader, 'load'):
             raise api.CommandError('loader has no load method')
+        options = {}
+        if path is not None:
+            if 'subtree' not in inspect.signature(loader.load).parameters:
+                raise api.CommandError('loader cannot load a subtree')
+            options['subtree'] = path
         prev = api.log.disable_all, api.log.is_startup
         api.log.disable_all = False
         api.log.is_startup = True
@@ -363,16 +413,118 @@ class LoadCommand(api.Command):
         api._import_base_plugin(reload=True)
         api.log.new_hooks = 0
         api.log.new_loaders = 0
-        r = loader.load(file)
+        r = loader.load(file, **options)
         api.log.disable_all, api.log.is_startup = prev
         # run the loading command
         api.tree = api.Tree(r)
+        if path is not None:
+            api.tree.partial = api.log.data_source
         # value of first (loader) command to be run
 
+    async def execute_async(self, **inputs):
+        return await api.to_thread(self.execute, **inputs)
+        # the event loop of api.run_async stays free while reading
+
+    def input_handler_loader(self, i):
+        return ' '.join(i.split())
+
+
+class ProfileCommand(api.Command):
+    """Command to time hooks, commands, input handlers and loaders."""
+
+    ID = 'profile'
+    signature = '<on>|<off>|<report>|<reset>|({dump} STRING=file)'
+    defaults = {'file': None}
+    description = ('time hooks, commands, input handlers and loaders, and '
+                   'report or dump the results')
+
+    def execute(self, on, off, report, reset, dump, file):
+        if on or off:
+            api.set_profiling(on)
+            print('Profiling is {}'.format('on' if on else 'off'))
+        elif report:
+            print(api.profiler.report())
+        elif reset:
+            api.profiler.reset()
+        elif dump:
+            api.profiler.dump(file)
+            print('Profile written to {}'.format(file))
+        else:
+            raise api.InputError('no argument given')
+
+
+class AutosaveCommand(api.Command):
+    """Command to save the data tree automatically in the background."""
+
+    ID = 'autosave'
+    signature = ('<off> <now> <status> [every NUMBER/positive=seconds] '
+                 '[after NUMBER/positive=edits] [to STRING=file] '
+                 '[using STRING=loader]')
+    defaults = {'seconds': None, 'edits': None, 'file': None,
+                'loader': 'default'}
+    description = ('save a copy of the data tree every number of seconds '
+                   'and/or edits without blocking the command line')
+
+    def execute(self, off, now, status, seconds, edits, file, loader):
+        autosave = api.autosave
+        if off:
+            autosave.configure()
+            print('Autosave is off')
+        elif now:
+            autosave.wait()  # for a save already being written
+            file = autosave.save()
+            autosave.wait()
+            if autosave.error is not None:
+                raise api.CommandError(f'autosave failed: {autosave.error}')
+            print('Saved to {}'.format(file))
+        elif status:
+            if not autosave.enabled:
+                print('Autosave is off')
+                return
+            print('Autosaving to {} using loader \'{}\''.format(
+                autosave.file or autosave.default_file(), autosave.loader
+            ))
+            print('{} edit(s) since the last save'.format(
+                autosave.edit_count
+            ))
+            if autosave.error is not None:
+                print('The last save failed:', autosave.error)
+        elif seconds is None and edits is None:
+            raise api.InputError('no argument given')
+        else:
+            autosave.configure(seconds, edits, file, loader)
+            print('Autosave is on')
+
     def input_handler_loader(self, i):
         return ' '.join(i.split())
 
 
+class WatchCommand(api.Command):
+    """Command to reload the data file when it is edited elsewhere."""
+
+    ID = 'watch'
+    signature = '<off> <status> [every NUMBER/positive=seconds]'
+    defaults = {'seconds': 1}
+    description = ('reload the sections of the data file that are edited '
+                   'outside tagger, checking every number of seconds')
+
+    def execute(self, off, status, seconds):
+        watcher = api.watcher
+        if off:
+            watcher.configure()
+            print('Watch is off')
+        elif status:
+            if not watcher.enabled:
+                print('Watch is off')
+                return
+            print('Watching {} every {} second(s)'.format(
+                watcher.file, watcher.interval
+            ))
+        else:
+            watcher.configure(seconds)
+            print('Watch is on')
+
+
 class SetCommand(api.Command):
     """Set api.log values."""
 
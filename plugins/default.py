@@ -507,3 +507,69 @@ class GotoCommand(api.Command):
         api.test_input(i, 'input must be node reference',
                        api.is_node)
         return i
+
+
+class FollowLinkCommand(api.Command):
+
+    ID = 'follow link'
+    signature = 'NUMBER/positive=index?'
+    defaults = {'index': None}
+    description = 'move traversal to a node targeted by a link tag'
+
+    def execute(self, index):
+        targets = api.follow_link()
+        if not targets:
+            raise api.NodeError('current node has no resolvable links')
+        if index is None and len(targets) > 1:
+            print('The current node links to:')
+            for i, node in enumerate(targets, 1):
+                print('{:>3} {}'.format(i, api.reference_string(node)))
+            print('Use \'follow link n\' to choose one')
+            return
+        index = index or 1
+        if index > len(targets):
+            raise api.InputError('link index must not exceed {}'
+                                 .format(len(targets)))
+        api.switch_node(targets[index - 1])
+
+
+class BacklinksCommand(api.Command):
+
+    ID = 'backlinks'
+    signature = 'NODEREF=node?'
+    defaults = {'node': None}
+    description = 'list the nodes that link to the current node or another'
+
+    def execute(self, node):
+        sources = api.backlinks(node)
+        if not sources:
+            print('No nodes link here')
+            return
+        for i, source in enumerate(sources, 1):
+            print('{:>3} {}'.format(i, api.reference_string(source)))
+
+    def input_handler_node(self, i):
+        i = api.evaluate_node_reference(i)
+        api.test_input(i, 'input must be node reference', api.is_node)
+        return i
+
+
+class ReachableCommand(api.Command):
+
+    ID = 'reachable'
+    signature = 'NODEREF=node?'
+    defaults = {'node': None}
+    description = 'list the nodes reachable by following links'
+
+    def execute(self, node):
+        nodes = api.reachable(node)
+        if not nodes:
+            print('No nodes are reachable by links')
+            return
+        for i, target in enumerate(nodes, 1):
+            print('{:>3} {}'.format(i, api.reference_string(target)))
+
+    def input_handler_node(self, i):
+        i = api.evaluate_node_reference(i)
+        api.test_input(i, 'input must be node reference', api.is_node)
+        return i
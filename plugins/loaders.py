@@ -1,10 +1,18 @@
 """Defines commanda to load a data tree from different formats."""
 
+import os
+import re
 import json
+from functools import partial
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
 
 from tagger import api
-from tagger import lexers
+from tagger import lazy
 from tagger import parsers
+from tagger import store
+from tagger import shards
+from tagger.compression import open_source, open_output
 from tagger import structure
 
 
@@ -14,121 +22,665 @@ class JSONLoaderCommand(api.Loader):
     ID = 'json'
 
     def load(self, file):
-        with open(file, 'r') as f:
-            try:
-                object = json.load(f)
-            except json.decoder.JSONDecodeError as e:
-                raise api.CommandError(f'cannot load file:\n{str(e)}')
-            if 'data' not in object:
+        with open_source(file) as f:
+            root = self.construct(json_events(f))
+        shards.mount(root, file)
+        return root
+
+    def construct(self, events):
+        """Build a data tree from the events of json_events().
+
+        Nodes are created as their events arrive, without recursion; the
+        children of a node are attached and passed to the post node
+        creation hook together when the node ends.
+
+        events: [iterator: tuple]
+
+        return: data tree [structure.Root]
+        """
+        stack = []  # [node, data, pending tags, depth, children]
+        with api.batch(rollback=False):
+            for event in events:
+                kind = event[0]
+                if kind == 'start':
+                    if stack:
+                        self.create(stack)
+                    stack.append([None, None, [], len(stack), []])
+                elif kind == 'data':
+                    stack[-1][1] = event[1]
+                elif kind == 'tags':
+                    stack[-1][2].append(event[1])
+                    if stack[-1][0] is not None:
+                        self.create(stack)  # node exists; add tags now
+                else:  # end
+                    node = self.create(stack)
+                    children = stack.pop()[4]
+                    if children:
+                        node.children.extend(children)
+                        # looked up here, as the root's config tag
+                        # replaces api.plugin
+                        plugin = api.plugin
+                        if not plugin.elided('post_node_creation_hook'):
+                            plugin.call_batch('post_node_creation_hook',
+                                              children)
+            return node
+
+    def create(self, stack):
+        """Create the node of the innermost frame if needed, then tag it."""
+        frame = stack[-1]
+        node, data, tags, depth, _ = frame
+        if node is None and depth == 0:
+            if data is None:
                 api.warning('no tree title given, defaulting to Tree')
-                object['data'] = 'Tree'
-            root = structure.Root(object['data'])
-            tags = object.get('tags', {})
-            if 'config' in tags:
-                self.found_plugin_file(tags['config'])
-            self.add_tags(root, tags)
-            for child in object.get('children', []):
-                root.children.append(self.recursive_construct(
-                    child, depth=1, parent=root
-                ))
-            return root
-
-    def recursive_construct(self, object, depth, parent):
-        if 'data' not in object:
-            raise SyntaxError(f'no data for node at level {depth} '
+                data = 'Tree'
+            node = structure.Root(data)
+            config = tags and isinstance(tags[0], dict) and tags[0].get(
+                'config')
+            if config:
+                self.found_plugin_file(config)
+        elif node is None:
+            parent = stack[-2][0]
+            if data is None:
+                raise SyntaxError(f'no data for node at level {depth} '
+                                  f'(parent: {parent.data})')
+            if not api.plugin.elided('pre_node_creation_hook'):
+                data = api.plugin.pre_node_creation_hook(
+                    data, depth, parent.traversal_depth
+                )
+            if not api.tests.not_whitespace(data):
+                raise api.NodeError('data cannot be empty')
+            node = structure.Node(data, depth, parent)
+            stack[-2][4].append(node)
+        frame[0] = node
+        for object in tags:
+            _add_tags(node, object)
+        tags.clear()
+        return node
+
+    def save(self, file, root=None, workers=None, compact=False,
+             compression=None):
+        if root is None:
+            root = api.tree.root
+        if lazy.reads_from(root, file):
+            api.materialize(root)  # before the file is truncated
+        root = shards.save(root)  # included files are written separately
+        indent = None if compact else 2
+        workers = _save_workers(root, workers)
+        children = None
+        if workers > 1 and root.children:
+            children = _render_parallel(partial(_render_json, indent=indent),
+                                        root.children, workers)
+        with open_output(file, compression) as f:
+            f.writelines(json_chunks(root, indent, children))
+
+
+class DefaultLoaderCommand(api.Loader):
+    """Load a data tree from tagger format."""
+
+    ID = 'default'
+
+    def load(self, file, workers=None, subtree=None):
+        with open_source(file) as f:
+            source = f.read()
+        if subtree is not None:
+            root = parsers.parse_subtree(source, subtree)
+        else:
+            root = parsers.parse_tree(source, workers)
+        shards.mount(root, file)
+        return root
+
+    def save(self, file, root=None, workers=None, compression=None):
+        if root is None:
+            root = api.tree.root
+        if lazy.reads_from(root, file):
+            api.materialize(root)  # before the file is truncated
+        root = shards.save(root)  # included files are written separately
+        workers = _save_workers(root, workers)
+        lines = [format_data(root.data, 0)]
+        _append_tags(lines, root.tags.copy(), 0)
+        lines.append('')
+        with open_output(file, compression) as f:
+            f.write('\n'.join(lines))
+            if workers == 1:
+                children = (render_subtree(child) for child in root.children)
+            else:
+                children = _render_parallel(_render_tagger, root.children,
+                                            workers)
+            f.writelines(_joined(children, '\n', first='\n'))
+
+
+class NDJSONLoaderCommand(api.Loader):
+    """Load a data tree from newline-delimited JSON, one node per line.
+
+    Each line is an object with the node's 'id', the 'parent' id (null
+    for the root, which comes first), its 'data' and optionally its
+    'tags'. Parents must come before their children.
+    """
+
+    ID = 'ndjson'
+    HOOK_BATCH = 1024  # nodes passed to the post node creation hook at once
+
+    def load(self, file):
+        with open_source(file) as f:
+            root = self.construct(f)
+        shards.mount(root, file)
+        return root
+
+    def construct(self, lines):
+        """Build a data tree from node records in a single pass.
+
+        lines: JSON text of each record [iterable: str]
+
+        return: data tree [structure.Root]
+        """
+        nodes = {}  # id -> node
+        created = []
+        root = None
+        with api.batch(rollback=False):
+            for number, line in enumerate(lines, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    raise api.CommandError(
+                        f'cannot load file:\nline {number}: {e}'
+                    )
+                if not isinstance(record, dict):
+                    raise api.CommandError(f'line {number}: each record '
+                                           'must be an object')
+                parent = record.get('parent')
+                if root is None:
+                    if parent is not None:
+                        raise api.CommandError(f'line {number}: the first '
+                                               'record must be the root')
+                    root = node = self.create_root(record)
+                else:
+                    try:
+                        parent = nodes[parent]
+                    except (KeyError, TypeError):
+                        raise api.CommandError(
+                            f'line {number}: no parent with id {parent!r}'
+                        )
+                    node = self.create(record, parent, number)
+                    created.append(node)
+                if 'id' in record:
+                    nodes[record['id']] = node
+                _add_tags(node, record.get('tags', {}))
+                if len(created) >= self.HOOK_BATCH:
+                    self.created(created)
+            if root is None:
+                raise api.CommandError('cannot load file:\nno nodes found')
+            self.created(created)
+        return root
+
+    def create_root(self, record):
+        data = record.get('data')
+        if data is None:
+            api.warning('no tree title given, defaulting to Tree')
+            data = 'Tree'
+        tags = record.get('tags')
+        if isinstance(tags, dict) and tags.get('config'):
+            self.found_plugin_file(tags['config'])
+        return structure.Root(data)
+
+    def create(self, record, parent, number):
+        try:
+            data = record['data']
+        except KeyError:
+            raise SyntaxError(f'no data for node on line {number} '
                               f'(parent: {parent.data})')
-        node = api.new_node(object['data'], parent)
-        self.add_tags(node, object.get('tags', {}))
-        for child in object.get('children', []):
-            node.children.append(self.recursive_construct(
-                child, depth=depth+1, parent=node
-            ))
+        depth = parent.depth + 1
+        if not api.plugin.elided('pre_node_creation_hook'):
+            data = api.plugin.pre_node_creation_hook(
+                data, depth, parent.traversal_depth
+            )
+        if not api.tests.not_whitespace(data):
+            raise api.NodeError('data cannot be empty')
+        node = structure.Node(data, depth, parent)
+        parent.children.append(node)
         return node
 
-    def add_tags(self, node, tags):
-        for k, v in tags.items():
-            if not isinstance(v, list):
-                api.append_tag_value(k, v, node, create=True)
+    @staticmethod
+    def created(nodes):
+        """Pass created nodes to the post node creation hook."""
+        plugin = api.plugin  # replaced when the root's config tag is read
+        if nodes and not plugin.elided('post_node_creation_hook'):
+            plugin.call_batch('post_node_creation_hook', list(nodes))
+        nodes.clear()
+
+    def save(self, file, root=None, compression=None):
+        if root is None:
+            root = api.tree.root
+        if lazy.reads_from(root, file):
+            api.materialize(root)  # before the file is truncated
+        root = shards.save(root)  # included files are written separately
+        with open_output(file, compression) as f:
+            f.writelines(_joined(ndjson_lines(root), ''))
+
+
+class SQLiteLoaderCommand(api.Loader):
+    """Keep a data tree in an SQLite database (see tagger.store).
+
+    Nodes are selected from the database as they are used; saving back to
+    the database the tree was loaded from writes only the changes.
+    """
+
+    ID = 'sqlite'
+
+    def load(self, file):
+        return store.open_tree(file)
+
+    def save(self, file, root=None):
+        if root is None:
+            root = api.tree.root
+        store.save_tree(file, root)
+
+
+def _add_tags(node, tags):
+    if not isinstance(tags, dict):
+        raise api.CommandError(f'tags of \'{node.data}\' must be an object')
+    for k, v in tags.items():
+        if not isinstance(v, list):
+            api.append_tag_value(k, v, node, create=True)
+            continue
+        for i in v:
+            api.append_tag_value(k, i, node, create=True)
+        # create new tags (or append to existing if duplicate names)
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class _JSONReader:
+    """Read JSON tokens and values from a file a chunk at a time."""
+
+    def __init__(self, file, chunk_size=1 << 16):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0       # index of the next character in the buffer
+        self.offset = 0    # number of characters before the buffer
+        self.line = 1      # line and column of the start of the buffer
+        self.column = 1
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        """Read more of the file, dropping what has been consumed.
+
+        At least as much is read as is left unconsumed, so retrying a
+        long value after each fill takes linear time overall.
+
+        return: whether anything was read [bool]
+        """
+        if self.eof:
+            return False
+        more = self.file.read(max(self.chunk_size,
+                                  len(self.buffer) - self.pos))
+        if not more:
+            self.eof = True
+            return False
+        self.line, self.column = self.position(self.pos)
+        self.offset += self.pos
+        self.buffer = self.buffer[self.pos:] + more
+        self.pos = 0
+        return True
+
+    def position(self, pos):
+        """Return the line and column of an index in the buffer."""
+        newlines = self.buffer.count('\n', 0, pos)
+        if not newlines:
+            return self.line, self.column + pos
+        return self.line + newlines, pos - self.buffer.rfind('\n', 0, pos)
+
+    def peek(self):
+        """Skip whitespace and return the next character ('' at the end)."""
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or not self.fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, chars, what):
+        """Consume the next character, which must be one of chars."""
+        char = self.peek()
+        if not char or char not in chars:
+            self.error(f'Expecting {what}')
+        self.pos += 1
+        return char
+
+    def string(self):
+        """Consume a string, such as an object key."""
+        if self.peek() != '"':
+            self.error('Expecting property name enclosed in double quotes')
+        return self.value()
+
+    def value(self):
+        """Consume a complete JSON value of any type."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.decoder.JSONDecodeError as e:
+                if not self.fill():
+                    self.error(e.msg, e.pos)
+                continue
+            if end < len(self.buffer) or not self.fill():
+                self.pos = end  # else a number may continue after a fill
+                return value
+
+    def error(self, msg, pos=None):
+        if pos is None:
+            pos = self.pos
+        line, column = self.position(pos)
+        raise api.CommandError(
+            f'cannot load file:\n{msg}: line {line} column {column} '
+            f'(char {self.offset + pos})'
+        )
+
+
+def json_events(file):
+    """Generate the nodes of a JSON data tree as they are read from a file.
+
+    Only the node being read and its unclosed ancestors are held in
+    memory. Events are ('start',) and ('end',) around each node, with
+    ('data', value) and ('tags', object) in between and the events of its
+    children after its data. If a node's children come before its data in
+    the file, they are decoded whole and given after the data.
+
+    file: text file to read [file object]
+
+    return: [iterator: tuple]
+    """
+    reader = _JSONReader(file)
+    reader.expect('{', '\'{\'')
+    yield ('start',)
+    stack = [_Frame()]
+    names = {}
+    while stack:
+        frame = stack[-1]
+        if frame.in_children:
+            if reader.expect(',]' if frame.members else '{]',
+                             '\',\' or \']\'' if frame.members
+                             else '\'{\' or \']\'') == ']':
+                frame.in_children = False
                 continue
+            if frame.members:
+                reader.expect('{', '\'{\'')
+            frame.members += 1
+            stack.append(_Frame())
+            yield ('start',)
+            continue
+        if reader.expect(',}' if frame.keys else '"}',
+                         '\',\' or \'}\'' if frame.keys
+                         else 'property name or \'}\'') == '}':
+            stack.pop()
+            if frame.buffered:
+                yield from _object_events(frame.buffered, reader)
+            yield ('end',)
+            continue
+        if not frame.keys:
+            reader.pos -= 1  # the key's opening quote
+        frame.keys += 1
+        key = reader.string()
+        reader.expect(':', '\':\' delimiter')
+        if key == 'data':
+            frame.data = True
+            yield ('data', reader.value())
+        elif key == 'tags':
+            tags = reader.value()
+            if isinstance(tags, dict):  # share tag names, as json.load does
+                tags = {names.setdefault(k, k): v for k, v in tags.items()}
+            yield ('tags', tags)
+        elif key == 'children':
+            if frame.data and reader.peek() == '[':
+                reader.pos += 1
+                frame.in_children = True
+            else:
+                frame.buffered = reader.value()
+        else:
+            reader.value()  # unknown keys are ignored
+    if reader.peek():
+        reader.error('Extra data')
+
+
+class _Frame:
+    """State of an object being read by json_events()."""
+
+    __slots__ = ('keys', 'data', 'in_children', 'members', 'buffered')
+
+    def __init__(self):
+        self.keys = 0              # keys read so far
+        self.data = False          # whether 'data' has been read
+        self.in_children = False   # whether inside the 'children' array
+        self.members = 0           # children read so far
+        self.buffered = None       # children read before the data
+
+
+def _object_events(children, reader):
+    """Generate json_events() events for already decoded children."""
+    if not isinstance(children, list):
+        reader.error('Expecting \'children\' to be an array')
+    stack = [iter(children)]
+    while stack:
+        child = next(stack[-1], _Frame)
+        if child is _Frame:
+            stack.pop()
+            if stack:
+                yield ('end',)
+            continue
+        if not isinstance(child, dict):
+            reader.error('Expecting each child to be an object')
+        yield ('start',)
+        if 'data' in child:
+            yield ('data', child['data'])
+        if 'tags' in child:
+            yield ('tags', child['tags'])
+        grandchildren = child.get('children') or []
+        if not isinstance(grandchildren, list):
+            reader.error('Expecting \'children\' to be an array')
+        stack.append(iter(grandchildren))
+
+
+PARALLEL_SAVE_NODES = 100000  # trees this large are saved in parallel
+
+
+def format_data(line, depth):
+    """Format node data as a line of the tagger format."""
+    line = line.replace('*', '\\*')
+    line = line.replace('`', '\\`')
+    line = line.replace('\\', '\\\\')
+    return '{}{}'.format('*' * depth, line)
+
+
+def format_tag(tag, value, depth):
+    """Format a tag and one of its values as a line of the tagger format."""
+    tag = tag.replace('*', '\\*')
+    tag = tag.replace('`', '\\`')
+    tag = tag.replace('=', '\\=')
+    tag = tag.replace('\\', '\\\\')
+    if value:
+        return '{}`{}={}'.format('*' * depth, tag, value)
+    return '{}`{}'.format('*' * depth, tag)
+
+
+def _append_tags(lines, tags, depth):
+    for k, v in tags.items():
+        if v is None:
+            v = ''
+        if isinstance(v, list):
             for i in v:
-                api.append_tag_value(k, i, node, create=True)
-            # create new tags (or append to existing if duplicate names)
+                lines.append(format_tag(k, i, depth))
+                # separate 'list' tags into multiple
+        else:
+            lines.append(format_tag(k, v, depth))
+
+
+def render_subtree(node, depth=1):
+    """Render a node and its descendants in the tagger format.
+
+    node: the node to render [NodeType/structure.SnapshotNode]
+    depth: [default=1] depth of the node in the tree [int]
+
+    return: the lines of the subtree, each ending with a newline [str]
+    """
+    lines = []
+    stack = [(node, depth)]
+    while stack:
+        node, depth = stack.pop()
+        lines.append(format_data(node.data, depth))
+        _append_tags(lines, node.tags, depth)
+        stack.extend((child, depth + 1) for child in reversed(node.children))
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def json_chunks(root, indent=2, children=None):
+    """Generate a data tree as JSON text, in blocks for writing.
 
-    def save(self, file):
-        object = self.recursive_convert(api.tree.root)
-        with open(file, 'w') as f:
-            json.dump(object, f, indent=2)
+    The text is the same as json.dump() gives for nested objects with
+    'data', 'tags' and 'children' keys, but the tree is walked without
+    recursion or building those objects.
 
-    def recursive_convert(self, node):
-        object = {'data': node.data}
+    root: the node to write [NodeType/structure.SnapshotNode]
+    indent: [default=2] spaces to indent each level by, or None for
+            compact output on one line [int]
+    children: [optional] the text of each of the root's children,
+              rendered by _json_pieces() at level 2 [iterable: str]
+
+    return: [iterator: str]
+    """
+    return _joined(_json_pieces(root, indent, children=children), '')
+
+
+def _json_pieces(node, indent, level=0, children=None):
+    if indent is None:
+        separators = (',', ':')
+    else:
+        separators = (',', ': ')
+    key = separators[1]
+
+    def newline(level):
+        if indent is None:
+            return ''
+        return '\n' + ' ' * (indent * level)
+
+    def dumps(value, level):
+        text = json.dumps(value, indent=indent, separators=separators)
+        if indent is None:
+            return text
+        return text.replace('\n', newline(level))
+
+    def opening(node, level, has_children):
+        inner = newline(level + 1)
+        text = '{' + inner + '"data"' + key + dumps(node.data, level + 1)
         tags = getattr(node, 'tags', None)
         if tags:
-            object['tags'] = tags
+            text += ',' + inner + '"tags"' + key + dumps(tags, level + 1)
+        if has_children:
+            return text + ',' + inner + '"children"' + key + '['
+        return text + newline(level) + '}'
+
+    def closing(level):
+        return newline(level + 1) + ']' + newline(level) + '}'
+
+    if children is not None:
+        yield opening(node, level, True)
+        separator = newline(level + 2)
+        for text in children:
+            yield separator + text
+            separator = ',' + newline(level + 2)
+        yield closing(level)
+        return
+    yield opening(node, level, bool(node.children))
+    if not node.children:
+        return
+    stack = [(iter(node.children), level)]
+    separator = newline(level + 2)
+    while stack:
+        siblings, level = stack[-1]
+        child = next(siblings, None)
+        if child is None:
+            stack.pop()
+            yield closing(level)
+            separator = ',' + newline(level)
+            continue
+        yield separator + opening(child, level + 2, bool(child.children))
+        if child.children:
+            stack.append((iter(child.children), level + 2))
+            separator = newline(level + 4)
+        else:
+            separator = ',' + newline(level + 2)
+
+
+def ndjson_lines(root):
+    """Generate a line of NDJSON for each node of a tree, in preorder.
+
+    Nodes are numbered from 0 (the root) in the order they are written.
+
+    root: [NodeType/structure.SnapshotNode]
+
+    return: [iterator: str]
+    """
+    yield _ndjson_record(0, None, root)
+    count = 1
+    stack = [(iter(root.children), 0)]
+    while stack:
+        siblings, parent = stack[-1]
+        node = next(siblings, None)
+        if node is None:
+            stack.pop()
+            continue
+        yield _ndjson_record(count, parent, node)
         if node.children:
-            object['children'] = [
-                self.recursive_convert(child) for child in node.children
-            ]
-        return object
+            stack.append((iter(node.children), count))
+        count += 1
 
 
-class DefaultLoaderCommand(api.Loader):
-    """Load a data tree from tagger format."""
+def _ndjson_record(id, parent, node):
+    record = {'id': id, 'parent': parent, 'data': node.data}
+    if node.tags:
+        record['tags'] = node.tags
+    return json.dumps(record) + '\n'
 
-    ID = 'default'
 
-    def load(self, file):
-        with open(file, 'r') as f:
-            source = f.read()
-        parser = parsers.InputPatternParser(lexers.InputLexer(source))
-        return parsers.construct_tree(parser)
-
-    def save(self, file):
-        self.depth = 0
-        with open(file, 'w') as f:
-            self.file = f
-            self.write_data(api.tree.root.data)
-            tags = api.tree.root.tags.copy()
-            self.write_tags(tags)
-            for child in api.tree.root.children:
-                self.write_line('')
-                self.recursive_save(child)
-
-    def recursive_save(self, node):
-        self.depth += 1
-        self.write_data(node.data)
-        self.write_tags(node.tags)
-        for child in node.children:
-            self.recursive_save(child)
-        self.depth -= 1
-
-    def write_tags(self, tags):
-        for k, v in tags.items():
-            if v is None:
-                v = ''
-            if isinstance(v, list):
-                for i in v:
-                    self.write_line(self.format_tag(k, i))
-                    # separate 'list' tags into multiple
-            else:
-                self.write_line(self.format_tag(k, v))
-
-    def write_data(self, data):
-        self.write_line(self.format_data(data))
-
-    def format_data(self, line):
-        line = line.replace('*', '\\*')
-        line = line.replace('`', '\\`')
-        line = line.replace('\\', '\\\\')
-        return '{}{}'.format('*' * self.depth, line)
-
-    def format_tag(self, tag, value=''):
-        tag = tag.replace('*', '\\*')
-        tag = tag.replace('`', '\\`')
-        tag = tag.replace('=', '\\=')
-        tag = tag.replace('\\', '\\\\')
-        if value:
-            return '{}`{}={}'.format('*' * self.depth, tag, value)
-        return '{}`{}'.format('*' * self.depth, tag)
-
-    def write_line(self, line):
-        self.file.write('{}\n'.format(line))
+def _render_tagger(packed):
+    return render_subtree(structure.unpack(packed))
+
+
+def _render_json(packed, indent):
+    """Render a top-level subtree as an element of the root's children."""
+    return ''.join(_json_pieces(structure.unpack(packed), indent, level=2))
+
+
+def _save_workers(root, workers):
+    """Choose the number of processes to render a tree with."""
+    if workers is not None:
+        return workers
+    nodes = structure.walk(root)
+    if next(islice(nodes, PARALLEL_SAVE_NODES, None), None) is None:
+        return 1  # fewer than PARALLEL_SAVE_NODES nodes
+    return os.cpu_count() or 1
+
+
+def _render_parallel(render, nodes, workers):
+    """Render top-level subtrees in worker processes, yielding in order."""
+    packed = [structure.pack(node) for node in nodes]
+    chunksize = max(1, len(packed) // (workers * 4))
+    with ProcessPoolExecutor(workers) as pool:
+        yield from pool.map(render, packed, chunksize=chunksize)
+
+
+def _joined(chunks, separator, first=''):
+    """Yield chunks with a separator between them, in blocks for writing."""
+    block = []
+    size = 0
+    for chunk in chunks:
+        block.append(first)
+        block.append(chunk)
+        first = separator
+        size += len(chunk)
+        if size >= 1 << 20:
+            yield ''.join(block)
+            block, size = [], 0
+    yield ''.join(block)
@@ -0,0 +1,93 @@
+"""Opt-in timing of hooks, commands, input handlers and loaders."""
+
+import json
+import marshal
+from time import perf_counter
+from functools import wraps
+
+
+class Profiler:
+    """Record call counts and wall times of instrumented functions."""
+
+    def __init__(self):
+        self.enabled = False
+        self.stats = {}  # name -> [calls, total time, max time]
+
+    def record(self, name, elapsed):
+        """Add one call of the given duration to a name's statistics."""
+        try:
+            entry = self.stats[name]
+        except KeyError:
+            self.stats[name] = [1, elapsed, elapsed]
+            return
+        entry[0] += 1
+        entry[1] += elapsed
+        if elapsed > entry[2]:
+            entry[2] = elapsed
+
+    def wrap(self, name, func):
+        """Return a function that always records calls to func."""
+        @wraps(func)
+        def timed(*args, **kw):
+            start = perf_counter()
+            try:
+                return func(*args, **kw)
+            finally:
+                self.record(name, perf_counter() - start)
+        return timed
+
+    def instrument(self, name, func):
+        """Return a function that records calls to func while enabled."""
+        @wraps(func)
+        def instrumented(*args, **kw):
+            if not self.enabled:
+                return func(*args, **kw)
+            start = perf_counter()
+            try:
+                return func(*args, **kw)
+            finally:
+                self.record(name, perf_counter() - start)
+        return instrumented
+
+    def reset(self):
+        """Discard all recorded statistics."""
+        self.stats = {}
+
+    def report(self):
+        """Format the statistics as a table sorted by cumulative time.
+
+        return: [str]
+        """
+        if not self.stats:
+            return 'No calls recorded'
+        width = max(len(name) for name in self.stats)
+        lines = ['{:<{}} {:>9} {:>12} {:>12}'.format(
+            'name', width, 'calls', 'total (ms)', 'max (ms)'
+        )]
+        items = sorted(self.stats.items(), key=lambda x: x[1][1],
+                       reverse=True)
+        for name, (calls, total, maximum) in items:
+            lines.append('{:<{}} {:>9} {:>12.3f} {:>12.3f}'.format(
+                name, width, calls, total * 1000, maximum * 1000
+            ))
+        return '\n'.join(lines)
+
+    def dump(self, file):
+        """Write the statistics to a file.
+
+        file: path to write to; a '.json' file is written as JSON, any
+              other file in the marshal format read by pstats.Stats [str]
+        """
+        if file.endswith('.json'):
+            with open(file, 'w') as f:
+                json.dump({
+                    name: {'calls': calls, 'total': total, 'max': maximum}
+                    for name, (calls, total, maximum) in self.stats.items()
+                }, f, indent=2)
+            return
+        stats = {
+            ('tagger', 0, name): (calls, calls, total, total, {})
+            for name, (calls, total, maximum) in self.stats.items()
+        }
+        with open(file, 'wb') as f:
+            marshal.dump(stats, f)
@@ -0,0 +1,309 @@
+"""Serve one loaded data tree to many clients over a local socket.
+
+Requests and responses are newline-delimited JSON objects in the style of
+JSON-RPC 2.0:
+
+    {"id": 1, "method": "command", "params": {"line": "goto ~/eric"}}
+    {"id": 1, "result": {"output": "...", "returns": [["goto", "None"]]}}
+
+Read methods run concurrently; methods which may edit the tree hold the
+write lock of the session being served, so they run one at a time.
+"""
+
+import io
+import os
+import sys
+import json
+import socket
+import threading
+import traceback
+import socketserver
+
+from tagger import api
+
+
+class RemoteError(Exception):
+    """Raised by Client when the server returns an error."""
+
+
+class _ThreadOutput(io.TextIOBase):
+    """Stand-in for stdout which captures writes made by handler threads."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, s):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            return self.stream.write(s)
+        return buffer.write(s)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def parse_address(address):
+    """Split an address into a socket family and socket address.
+
+    address: a port number or 'host:port' for TCP, otherwise the path of
+             a Unix socket [str]
+
+    return: [tuple: int, str/tuple]
+    """
+    host, _, port = str(address).rpartition(':')
+    if port.isdigit():
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+    return socket.AF_UNIX, address
+
+
+def _resolve(path):
+    """Resolve an absolute node reference given as '~/a/1' or a list."""
+    if isinstance(path, str):
+        path = [int(i) if i.isdigit() else i
+                for i in path.strip('/').split('/') if i]
+    path = list(path or ['~'])
+    if path[0] != '~':
+        path.insert(0, '~')
+    return api.evaluate_node_reference(path)
+
+
+def describe(node):
+    """Convert a node into a JSON-serialisable summary."""
+    return {
+        'reference': api.reference_string(node),
+        'id': node.id,
+        'data': node.data,
+        'tags': node.tags,
+        'children': [child.data for child in node.children],
+    }
+
+
+class TreeServer:
+    """Dispatch requests to the API, locking the data tree as needed."""
+
+    def __init__(self, session=None):
+        self.session = session or api.current_session()
+        self.read_methods = {
+            'ping': lambda client: 'pong',
+            'get': lambda client, path='~': describe(_resolve(path)),
+            'children': lambda client, path='~': [
+                describe(child) for child in _resolve(path).children
+            ],
+            'backlinks': lambda client, path='~': [
+                api.reference_string(n) for n in api.backlinks(_resolve(path))
+            ],
+        }
+        self.write_methods = {
+            'command': self.command,
+            'tag': self.tag,
+            'save': self.save,
+        }
+
+    def dispatch(self, client, request):
+        """Run one request and return its response.
+
+        client: per-connection state [_Handler]
+        request: the decoded request [dict]
+
+        return: the response [dict]
+        """
+        id = request.get('id')
+        method = request.get('method')
+        params = request.get('params') or {}
+        try:
+            if method in self.read_methods:
+                with self.session.read():
+                    result = self._call(self.read_methods[method],
+                                        client, params)
+            elif method in self.write_methods:
+                with self.session.write():
+                    result = self._call(self.write_methods[method],
+                                        client, params)
+            else:
+                raise api.CommandError(f'unknown method \'{method}\'')
+        except (api.NodeError, api.CommandError, api.InputError,
+                api.APIWarning, SyntaxError, TypeError, ValueError) as e:
+            return {'id': id, 'error': {'type': type(e).__name__,
+                                        'message': str(e)}}
+        except Exception as e:
+            traceback.print_exc(file=sys.stderr)
+            return {'id': id, 'error': {'type': type(e).__name__,
+                                        'message': str(e)}}
+        return {'id': id, 'result': result}
+
+    def _call(self, method, client, params):
+        if isinstance(params, list):
+            return method(client, *params)
+        return method(client, **params)
+
+    def command(self, client, line):
+        """Run a CLI line from the client's current node."""
+        tree = api.tree
+        if client.current is None or getattr(client.current, '_deleted',
+                                             False):
+            client.current = tree.root
+        tree.current_node = client.current
+        output = sys.stdout.local.buffer = io.StringIO()
+        try:
+            returns = api._generate_commands(line)
+        except EOFError:
+            raise api.CommandError('command needs a reply to a prompt')
+        finally:
+            sys.stdout.local.buffer = None
+            client.current = api.tree.current_node if api.tree else None
+        return {'output': output.getvalue(),
+                'returns': [[ID, repr(value)] for ID, value in returns]}
+
+    def tag(self, client, path, name, value=None):
+        """Set the value of a tag, creating it if needed."""
+        api.set_tag_values([_resolve(path)], name, [value])
+        return None
+
+    def save(self, client, file=None, loader='default'):
+        """Save the data tree using a registered loader."""
+        file = file or api.log.data_source
+        try:
+            loader = api.loaders[loader]()
+        except KeyError:
+            raise api.CommandError(f'no loader \'{loader}\'')
+        api.check_save_target(file)
+        api.materialize()
+        loader.save(file)
+        api.log.unsaved_changes = False
+        if api.watcher.enabled and file == api.watcher.file:
+            api.watcher.remember()  # not an edit made elsewhere
+        return file
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Read newline-delimited requests from one client connection."""
+
+    def setup(self):
+        super().setup()
+        self.current = None  # the client's current node
+
+    def handle(self):
+        with self.server.tree_server.session:
+            self._handle()
+
+    def _handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError('request must be a JSON object')
+            except ValueError as e:
+                response = {'id': None, 'error': {'type': 'ParseError',
+                                                  'message': str(e)}}
+            else:
+                response = self.server.tree_server.dispatch(self, request)
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+    class _UnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+
+def serve(address):
+    """Serve the current data tree until interrupted.
+
+    address: port, 'host:port' or path of a Unix socket [str]
+    """
+    family, address = parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(address):
+            os.remove(address)  # left behind by a previous server
+        server = _UnixServer(address, _Handler)
+    else:
+        server = _TCPServer(address, _Handler)
+    server.tree_server = TreeServer()
+    prev_stdout, prev_stdin = sys.stdout, sys.stdin
+    prev_interactive = api.log.interactive
+    sys.stdout = _ThreadOutput(prev_stdout)
+    sys.stdin = api._Replies(None)
+    api.log.interactive = False
+    print(f'Serving on {address}', file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        sys.stdout, sys.stdin = prev_stdout, prev_stdin
+        api.log.interactive = prev_interactive
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.remove(address)
+
+
+class Client:
+    """Send requests to a running tagger server."""
+
+    def __init__(self, address):
+        family, address = parse_address(address)
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.connect(address)
+        self.file = self.socket.makefile('rwb')
+        self._next_id = 0
+
+    def call(self, method, *args, **params):
+        """Call a server method and return its result.
+
+        RemoteError is raised if the server returns an error.
+        """
+        self._next_id += 1
+        request = {'id': self._next_id, 'method': method,
+                   'params': list(args) if args else params}
+        self.file.write(json.dumps(request).encode() + b'\n')
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise RemoteError('connection closed by server')
+        response = json.loads(line)
+        if 'error' in response:
+            error = response['error']
+            raise RemoteError(f'{error["type"]}: {error["message"]}')
+        return response['result']
+
+    def command(self, line):
+        """Run a CLI line on the server and return its output."""
+        return self.call('command', line=line)['output']
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def run_client(address, lines, *, keep_going=False):
+    """Run CLI lines on a server, printing their output.
+
+    return: exit status, 0 if every line succeeded, else 1 [int]
+    """
+    status = 0
+    with Client(address) as client:
+        for number, line in enumerate(lines, 1):
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            try:
+                print(client.command(line), end='')
+            except RemoteError as e:
+                print(f'Error on line {number}: {e}', file=sys.stderr)
+                status = 1
+                if not keep_going:
+                    break
+    return status
@@ -0,0 +1,314 @@
+"""Mount data files as the subtrees of nodes tagged with their paths.
+
+A node tagged `include=FILE (the root or any other node) has the nodes of
+FILE, a file in the tagger format, as its children. The path is relative
+to the directory of the file holding the tag. The file is parsed the
+first time the node's children are used, except for the root's, which
+are needed straight away; a full load (api.materialize) parses all the
+files that are left in parallel.
+
+The title and root tags of an included file are kept only to be written
+back. Saving a tree writes the included nodes to their own files, and
+only those which were changed; the file the tree is saved to holds the
+include tags instead of the included nodes. An autosave writes changed
+files to their own autosave copies and leaves the files alone.
+"""
+
+import os
+import threading
+from copy import copy as _copy
+from contextlib import suppress
+from concurrent.futures import ProcessPoolExecutor
+
+from tagger import api
+from tagger import parsers
+from tagger import structure
+from tagger.compression import open_source, detect
+
+INCLUDE_TAG = 'include'
+mounted = False  # set when a file is first mounted; until then, edits do
+                 # not look for the shard holding the node
+
+
+class ShardNode(structure.LazyNode):
+    """A node whose children are the nodes of another data file.
+
+    shard: the file mounted below the node [Shard]
+    """
+
+
+class Shard:
+    """A data file mounted below a node.
+
+    file: absolute path of the file [str]
+    title, tags: the title and root tags written back to the file
+    dirty: whether the nodes below the node changed since they were last
+           read or written [bool]
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.title = None
+        self.tags = {}
+        self.dirty = False
+        self.copy_file = None  # set on the copies made by snapshot()
+        self.lock = threading.RLock()
+        self.loading = False
+
+    def read(self):
+        try:
+            with open_source(self.file) as f:
+                return f.read()
+        except OSError as e:
+            raise api.CommandError(f'cannot include \'{self.file}\': '
+                                   f'{e.strerror}')
+
+    def load(self, node, patterns=None):
+        """Parse the file and give its nodes to the node.
+
+        patterns: [optional] output of parsers.parse_patterns for the
+                  file, if it was already parsed [list: tuple]
+        """
+        with self.lock:
+            if self.loading or getattr(node, 'loaded', False):
+                return  # loaded by another thread, or used while loading
+            self.loading = True
+            try:
+                if patterns is None:
+                    patterns = parsers.parse_patterns(self.read())
+                children = self._construct(node, patterns)
+                if isinstance(node, ShardNode):
+                    node._children.extend(children)
+                    node._load = None
+                else:
+                    node.children.extend(children)  # the root
+                for child in children:
+                    mount(child, self.file)
+                self.dirty = False  # loading is not an edit of the file
+            finally:
+                self.loading = False
+
+    def _construct(self, node, patterns):
+        head = 0
+        if patterns and patterns[0][0] == parsers._TEXT:
+            self.title = patterns[0][1]
+            head = 1
+        while (head < len(patterns) and patterns[head][0] == parsers._TAG
+               and patterns[head][3] == 0):
+            _, name, value, *_ = patterns[head]
+            if name in self.tags:
+                if not isinstance(self.tags[name], list):
+                    self.tags[name] = [self.tags[name]]
+                self.tags[name].append(value)
+            else:
+                self.tags[name] = value
+            head += 1
+        shift = node.depth
+        patterns = [(kind, data, value, depth + shift, line, col)
+                    for kind, data, value, depth, line, col
+                    in patterns[head:]]
+        session = api.current_session()
+        # a private session: loading is not an edit of the tree, and a
+        # thread reading the tree must not need the write lock
+        try:
+            with api.Session(session.tree,
+                             log_values=dict(session.log_values)):
+                return parsers.construct_below(patterns, node)
+        except SyntaxError as e:
+            raise SyntaxError(f'in \'{self.file}\': {e}') from None
+
+    def save(self, node):
+        """Write the nodes below the node back to the file.
+
+        A copy made by snapshot() writes to its copy_file instead, through
+        a temporary file which replaces it.
+        """
+        root = structure.SnapshotNode(self.title or node.data, self.tags)
+        root.children = [master_view(child) for child in _children(node)]
+        compression = None
+        if os.path.exists(self.file):
+            compression = detect(self.file)  # kept as it was
+        loader = api.loaders['default']()
+        if self.copy_file is None:
+            loader.save(self.file, root=root, compression=compression)
+        else:
+            base, ext = os.path.splitext(self.copy_file)
+            temp = f'{base}.{os.getpid()}.tmp{ext}'
+            try:
+                loader.save(temp, root=root, compression=compression)
+                os.replace(temp, self.copy_file)
+            except BaseException:
+                with suppress(OSError):
+                    os.remove(temp)
+                raise
+        self.dirty = False
+
+
+def mount(node, file):
+    """Mount the files included by a node and its descendants.
+
+    node: [NodeType]
+    file: path of the file holding the nodes, which include paths are
+          relative to [str/None]
+    """
+    global mounted
+    base = os.path.dirname(os.path.abspath(file or ''))
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        include = node.tags.get(INCLUDE_TAG)
+        if include and isinstance(include, str):
+            shard = Shard(os.path.join(base, include))
+            mounted = True
+            if isinstance(node, structure.Root):
+                stack.extend(node.children)
+                node.shard = shard
+                shard.load(node)  # the root's children are used at once
+                continue
+            children = node.__dict__.pop('children')
+            node.__class__ = ShardNode
+            node._children = children
+            node.shard = shard
+            node._load = shard.load
+        stack.extend(_children(node))
+
+
+def changed(node, children=False):
+    """Record that a node was edited, marking the shard holding it.
+
+    node: [NodeType]
+    children: [default=False] whether the node's list of children changed;
+              they are held by the node's own file if it has one, while
+              its data and tags are held by the file of its parent
+    """
+    nodes = node.traversal_depth
+    if not children:
+        nodes = nodes[:-1]
+    for node in reversed(nodes):
+        shard = getattr(node, 'shard', None)
+        if shard is not None:
+            shard.dirty = True
+            return
+
+
+def load_all(node, workers=None):
+    """Parse every file mounted below a node that has not been parsed.
+
+    The files are lexed and parsed in worker processes, then their nodes
+    are created here, as parsers.parse_tree does with sections.
+
+    node: [NodeType]
+    workers: [optional] number of processes; by default one per CPU if
+             there is more than one file to parse [int]
+    """
+    while True:
+        pending = [n for n in _walk(node) if isinstance(n, ShardNode)
+                   and not n.loaded]
+        if not pending:
+            return
+        sources = [n.shard.read() for n in pending]
+        count = workers
+        if count is None:
+            count = (os.cpu_count() or 1) if len(pending) > 1 else 1
+        if count > 1:
+            with ProcessPoolExecutor(min(count, len(pending))) as pool:
+                parsed = list(pool.map(parsers.parse_patterns, sources))
+        else:
+            parsed = map(parsers.parse_patterns, sources)
+        for n, patterns in zip(pending, parsed):
+            n.shard.load(n, patterns)  # nested includes are found next time
+
+
+def save(root):
+    """Write the mounted files that changed, for a tree about to be saved.
+
+    root: the live tree, or a copy of it made by snapshot()
+          [NodeType/structure.SnapshotNode]
+
+    return: the tree to write in place of root, without the nodes of the
+            mounted files [NodeType/structure.SnapshotNode]
+    """
+    if not mounted:
+        return root
+    for node in _walk(root):
+        shard = getattr(node, 'shard', None)
+        if shard is not None and shard.dirty:
+            shard.save(node)
+    return master_view(root)
+
+
+def snapshot(root, file, copy_name):
+    """Copy a tree so that it can be saved to another file while edited.
+
+    As structure.snapshot, except that the nodes of mounted files which
+    have not changed are left out, and each node with a mounted file keeps
+    a copy of its Shard. The files which changed are written to copies
+    (named by copy_name) when the snapshot is saved, never over the files
+    themselves, and the include tags of the snapshot name those copies.
+
+    root: [NodeType]
+    file: path of the file the snapshot will be saved to [str]
+    copy_name: function returning the path of the copy of a file
+
+    return: [structure.SnapshotNode]
+    """
+    if not mounted:
+        return structure.snapshot(root)
+    top = structure.SnapshotNode(root.data, structure._copy_tags(root.tags))
+    # each node with the directory its include path is relative to
+    stack = [(root, top, os.path.dirname(os.path.abspath(file)))]
+    while stack:
+        node, copy, directory = stack.pop()
+        shard = getattr(node, 'shard', None)
+        if shard is not None:
+            # saving the copy must not change the live shard's state
+            copy.shard = shard = _copy(shard)
+            target = shard.file
+            if shard.dirty:
+                shard.copy_file = target = copy_name(shard.file)
+            copy.tags[INCLUDE_TAG] = os.path.relpath(target, directory)
+            if not shard.dirty:
+                continue  # its file is not written; the nodes are left out
+            directory = os.path.dirname(shard.file)  # where the copy is
+        for child in _children(node):
+            child_copy = structure.SnapshotNode(
+                child.data, structure._copy_tags(child.tags)
+            )
+            copy.children.append(child_copy)
+            stack.append((child, child_copy, directory))
+    return top
+
+
+def master_view(node):
+    """Copy a subtree without the nodes of the files mounted in it.
+
+    Tags are shared with the tree, not copied.
+
+    return: [structure.SnapshotNode]
+    """
+    top = structure.SnapshotNode(node.data, node.tags)
+    stack = [(node, top)]
+    while stack:
+        node, copy = stack.pop()
+        if getattr(node, 'shard', None) is not None:
+            continue
+        for child in node.children:
+            child_copy = structure.SnapshotNode(child.data, child.tags)
+            copy.children.append(child_copy)
+            stack.append((child, child_copy))
+    return top
+
+
+def _children(node):
+    """Return the children of a node without loading a mounted file."""
+    if isinstance(node, ShardNode):
+        return node._children
+    return node.children
+
+
+def _walk(node):
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(_children(node)))
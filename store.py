@@ -0,0 +1,483 @@
+"""Keep a data tree in an SQLite database, loading nodes as they are used.
+
+The database has a row per node, holding its parent, its position among
+its siblings and its data, and a row per tag value. A tree opened from a
+database starts with only the root and its children in memory; the
+children of other nodes are selected when they are first used, like the
+sections of a lazily loaded file (see tagger.lazy).
+
+At most NodeStore.capacity loaded nodes are kept. Past that, the
+descendants of the least recently used nodes are dropped, if none of
+them has been edited, and selected again when they are next used.
+Saving back to the same database writes only what has changed, in a
+single transaction.
+"""
+
+import os
+import sqlite3
+import threading
+import collections
+from itertools import groupby
+
+from tagger import api
+from tagger import structure
+
+MAGIC = b'SQLite format 3\x00'  # start of every SQLite database file
+BATCH_ROWS = 10000  # rows inserted per executemany() call
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS nodes (
+    id INTEGER PRIMARY KEY,
+    parent INTEGER REFERENCES nodes (id),
+    position INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (parent, position);
+CREATE TABLE IF NOT EXISTS tags (
+    node INTEGER NOT NULL REFERENCES nodes (id),
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value,
+    list INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS tags_node ON tags (node, position);
+CREATE INDEX IF NOT EXISTS tags_name ON tags (name, value);
+'''
+
+_SUBTREE = '''
+WITH RECURSIVE subtree (id) AS (
+    SELECT ? UNION ALL
+    SELECT nodes.id FROM nodes JOIN subtree ON nodes.parent = subtree.id
+)
+'''
+
+
+class StoredNode(structure.LazyNode):
+    """A node held in a NodeStore.
+
+    row: id of the node's row in the database [int]
+    edited: whether the node's data or tags changed since it was last
+            written [bool]
+    """
+
+    _store = None
+
+    @property
+    def children(self):
+        load = self._load
+        if load is not None:
+            load(self)
+        elif self._store is not None:
+            self._store.touch(self)
+        return self._children
+
+    @children.setter
+    def children(self, value):
+        self._children = value
+        self._load = None
+
+    def mark_edited(self):
+        """Called by the API when the node's data or tags are changed."""
+        self.edited = True
+
+
+def is_database(file):
+    """Return whether a file is an SQLite database."""
+    try:
+        with open(file, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+class NodeStore:
+    """An SQLite database holding a data tree.
+
+    file: path of the database [str]
+    capacity: [default=NodeStore.capacity] number of loaded nodes kept
+              before the least recently used are dropped [int]
+    """
+
+    capacity = 100000
+
+    def __init__(self, file, capacity=None):
+        self.file = os.path.abspath(file)
+        if capacity is not None:
+            self.capacity = capacity
+        self.connection = sqlite3.connect(self.file, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.RLock()
+        self.loading = set()  # nodes whose children are being selected
+        self.stored = {}      # row -> rows of its children as last written,
+                              # for nodes with loaded children
+        self.recent = collections.OrderedDict()  # nodes with loaded children
+        self.size = 0         # number of nodes loaded below those nodes
+        self.flushing = False
+        self.root = None
+
+    def open_tree(self):
+        """Create a data tree holding the root and its children.
+
+        return: data tree [structure.Root]
+        """
+        row = self.connection.execute(
+            'SELECT id, data FROM nodes WHERE parent IS NULL'
+        ).fetchone()
+        if row is None:
+            raise api.CommandError(f'\'{self.file}\' holds no data tree')
+        tags = self.select_tags('node = ?', row[0]).get(row[0], {})
+        if tags.get('config'):
+            api.Loader.found_plugin_file(tags['config'])
+        else:
+            api.initialise_plugins()  # no config tag found
+        root = structure.Root(row[1], tags)
+        root.row = row[0]
+        root._store = self
+        self.root = root
+        self.load(root)
+        return root
+
+    def select_tags(self, where, *parameters):
+        """Select the tags of nodes matching a condition on the tags table.
+
+        return: tags of each node [dict: int -> dict]
+        """
+        rows = self.connection.execute(
+            f'SELECT node, name, value, list FROM tags WHERE {where} '
+            'ORDER BY node, position', parameters
+        )
+        tags = {}
+        for node, rows in groupby(rows, key=lambda row: row[0]):
+            node_tags = tags[node] = {}
+            for _, name, value, is_list in rows:
+                if is_list:
+                    node_tags.setdefault(name, []).append(value)
+                else:
+                    node_tags[name] = value
+        return tags
+
+    def load(self, node):
+        """Select the children of a node and give them to it."""
+        with self.lock:
+            if node in self.loading or getattr(node, 'loaded', False):
+                return  # loaded by another thread, or used while loading
+            self.loading.add(node)
+            try:
+                children = self._select_children(node)
+            finally:
+                self.loading.discard(node)
+            if isinstance(node, StoredNode):
+                node._children = children
+                node._load = None
+            else:
+                node.children = children  # the root
+            self.stored[node.row] = tuple(child.row for child in children)
+            self.recent[node] = None
+            self.size += len(children)
+            if self.size > self.capacity:
+                self.evict(keep=node)
+
+    def _select_children(self, node):
+        rows = self.connection.execute(
+            'SELECT id, data, EXISTS (SELECT 1 FROM nodes AS child '
+            'WHERE child.parent = nodes.id) FROM nodes WHERE parent = ? '
+            'ORDER BY position', (node.row,)
+        ).fetchall()
+        tags = self.select_tags(
+            'node IN (SELECT id FROM nodes WHERE parent = ?)', node.row
+        )
+        plugin = api.plugin
+        depth = node.depth + 1
+        children = []
+        session = api.current_session()
+        # a private session: loading is not an edit of the tree, and a
+        # thread reading the tree must not need the write lock
+        with api.Session(session.tree, log_values=dict(session.log_values)):
+            for row, data, has_children in rows:
+                if not plugin.elided('pre_node_creation_hook'):
+                    data = plugin.pre_node_creation_hook(
+                        data, depth, node.traversal_depth
+                    )
+                child = StoredNode(data, depth, node, tags.get(row, {}))
+                child.row = row
+                child._store = self
+                if has_children:
+                    child._load = self.load
+                children.append(child)
+            if children and not plugin.elided('post_node_creation_hook'):
+                plugin.call_batch('post_node_creation_hook', children)
+        for child in children:
+            child.edited = False  # hooks run again on every load
+        return children
+
+    def touch(self, node):
+        """Record that a node's children were used."""
+        try:
+            self.recent.move_to_end(node)
+        except KeyError:
+            pass
+
+    def evict(self, keep=None):
+        """Drop the descendants of the least recently used nodes.
+
+        Nodes are kept if they or any loaded descendant have unsaved
+        changes, or if they lead to the current node or to keep.
+
+        keep: [optional] a node whose children are about to be used
+        """
+        if self.flushing or api.current_session().batch is not None:
+            return  # the nodes are being written, or may be rolled back to
+        tree = api.tree
+        current = tree.current_node if tree is not None else None
+        keep = {*getattr(current, 'traversal_depth', ()),
+                *getattr(keep, 'traversal_depth', ())}
+        for node in list(self.recent):
+            if self.size <= self.capacity * 3 // 4:
+                break
+            if node is self.root or node in keep or node not in self.recent:
+                continue
+            loaded = list(self._walk(node))
+            if not all(self._unchanged(n) for n in loaded):
+                continue
+            for n in loaded:
+                if n in self.recent:
+                    del self.recent[n]
+                    self.size -= len(n._children)
+                    del self.stored[n.row]
+            node._children = []
+            node._load = self.load
+            if tree is not None:
+                tree.links = None  # rebuilt from the tree on next use
+
+    def _walk(self, node):
+        """Iterate over a node and its loaded descendants, loading none."""
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            yield node
+            if not isinstance(node, StoredNode):
+                stack.extend(node.children)
+            elif node.loaded:
+                stack.extend(node._children)
+
+    def _unchanged(self, node):
+        if not isinstance(node, StoredNode) or node.edited:
+            return False
+        if not node.loaded:
+            return True
+        return self.stored.get(node.row, ()) == tuple(
+            getattr(child, 'row', None) for child in node._children
+        )
+
+    def flush(self):
+        """Write every change to the loaded nodes in one transaction.
+
+        Nodes not loaded from the database are written in full each time.
+        """
+        with self.lock, self.connection:
+            self.flushing = True
+            try:
+                removed, seen, inserted = self._write_changes()
+            finally:
+                self.flushing = False
+            for row in removed - seen - inserted:
+                self.connection.execute(
+                    _SUBTREE + 'DELETE FROM tags WHERE node IN subtree',
+                    (row,)
+                )
+                self.connection.execute(
+                    _SUBTREE + 'DELETE FROM nodes WHERE id IN subtree', (row,)
+                )
+
+    def _write_changes(self):
+        writer = _Writer(self.connection)
+        seen = set()
+        removed = set()
+        for node in self._walk(self.root):
+            row = getattr(node, 'row', None)
+            if row is None:
+                continue  # inserted with its new parent
+            seen.add(row)
+            if not isinstance(node, StoredNode) or node.edited:
+                writer.update(node)
+            if isinstance(node, StoredNode):
+                if not node.loaded:
+                    continue
+                children = node._children
+            else:
+                children = node.children
+            rows = tuple(getattr(child, 'row', None) for child in children)
+            if rows == self.stored.get(row, ()):
+                continue
+            removed.update(self.stored.get(row) or ())
+            for position, child in enumerate(children):
+                if getattr(child, 'row', None) is None:
+                    writer.insert(child, row, position, self)
+                else:
+                    writer.move(child, row, position)
+            self.stored[row] = tuple(child.row for child in children)
+        writer.finish()
+        return removed, seen, writer.rows
+
+    def find(self, name, value=None):
+        """Find the nodes with a tag, using the index of tag names and values.
+
+        name: name of the tag [str]
+        value: [optional] one of the tag's values [str]
+
+        return: the nodes, loading their ancestors [list: NodeType]
+        """
+        if value is None:
+            rows = self.connection.execute(
+                'SELECT DISTINCT node FROM tags WHERE name = ?', (name,)
+            )
+        else:
+            rows = self.connection.execute(
+                'SELECT DISTINCT node FROM tags WHERE name = ? AND value = ?',
+                (name, value)
+            )
+        return [self.node(row) for row, in rows.fetchall()]
+
+    def node(self, row):
+        """Return the node with a row id, loading its ancestors."""
+        path = [row]
+        while True:
+            parent = self.connection.execute(
+                'SELECT parent FROM nodes WHERE id = ?', (path[-1],)
+            ).fetchone()
+            if parent is None:
+                raise api.NodeError(f'no node with row {row}')
+            if parent[0] is None:
+                break
+            path.append(parent[0])
+        node = self.root
+        for row in reversed(path[:-1]):
+            node = next(child for child in node.children
+                        if getattr(child, 'row', None) == row)
+        return node
+
+    def close(self):
+        self.connection.close()
+
+
+class _Writer:
+    """Batch the statements written by NodeStore.flush() and save_tree()."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.nodes = []   # (id, parent, position, data) to insert
+        self.tags = []    # (node, position, name, value, list) to insert
+        self.updates = []
+        self.rows = set()  # rows inserted
+        self.next_row = (connection.execute(
+            'SELECT MAX(id) FROM nodes'
+        ).fetchone()[0] or 0) + 1
+
+    def update(self, node):
+        self.updates.append((node.data, node.row))
+        self.connection.execute('DELETE FROM tags WHERE node = ?',
+                                (node.row,))
+        self.add_tags(node.row, node.tags)
+        if isinstance(node, StoredNode):
+            node.edited = False
+
+    def move(self, node, parent, position):
+        self.updates.append((parent, position, node.row))
+
+    def insert(self, node, parent, position, store=None):
+        """Insert a node and its descendants.
+
+        store: [optional] the NodeStore the rows are written for; the
+               nodes are given their row ids [NodeStore]
+        """
+        stack = [(node, parent, position)]
+        while stack:
+            node, parent, position = stack.pop()
+            row = self.next_row
+            self.next_row += 1
+            self.rows.add(row)
+            self.nodes.append((row, parent, position, node.data))
+            self.add_tags(row, node.tags)
+            stack.extend((child, row, i)
+                         for i, child in enumerate(node.children))
+            if store is not None:
+                node.row = row
+                store.stored[row] = None  # written in full on each flush
+            if len(self.nodes) >= BATCH_ROWS:
+                self.write()
+
+    def add_tags(self, row, tags):
+        position = 0
+        for name, value in tags.items():
+            values = value if isinstance(value, list) else [value]
+            for value in values:
+                if value is not None and not isinstance(
+                        value, (str, int, float)):
+                    value = str(value)
+                self.tags.append((row, position, name, value,
+                                  isinstance(tags[name], list)))
+                position += 1
+        if len(self.tags) >= BATCH_ROWS:
+            self.write()
+
+    def write(self):
+        self.connection.executemany(
+            'INSERT INTO nodes (id, parent, position, data) '
+            'VALUES (?, ?, ?, ?)', self.nodes
+        )
+        self.connection.executemany(
+            'INSERT INTO tags (node, position, name, value, list) '
+            'VALUES (?, ?, ?, ?, ?)', self.tags
+        )
+        self.nodes, self.tags = [], []
+
+    def finish(self):
+        self.write()
+        for update in self.updates:
+            if len(update) == 2:
+                self.connection.execute(
+                    'UPDATE nodes SET data = ? WHERE id = ?', update
+                )
+            else:
+                self.connection.execute(
+                    'UPDATE nodes SET parent = ?, position = ? WHERE id = ?',
+                    update
+                )
+        self.updates = []
+
+
+def open_tree(file, capacity=None):
+    """Open a data tree held in an SQLite database.
+
+    file: path of the database [str]
+    capacity: [optional] number of loaded nodes kept in memory [int]
+
+    return: data tree [structure.Root]
+    """
+    return NodeStore(file, capacity).open_tree()
+
+
+def save_tree(file, root):
+    """Save a data tree to an SQLite database.
+
+    If the tree was opened from the same database, only its changes are
+    written; otherwise the database is replaced with the whole tree.
+
+    file: path of the database [str]
+    root: [NodeType/structure.SnapshotNode]
+    """
+    store = getattr(root, '_store', None)
+    if store is not None and store.file == os.path.abspath(file):
+        store.flush()
+        return
+    temp = f'{file}.{os.getpid()}.tmp'
+    connection = sqlite3.connect(temp)
+    try:
+        with connection:
+            connection.executescript(SCHEMA)
+            writer = _Writer(connection)
+            writer.insert(root, None, 0)
+            writer.finish()
+    finally:
+        connection.close()
+    os.replace(temp, file)
@@ -1,5 +1,9 @@
 """Objects used for data parsing and to implement CLI/signature parsing."""
 
+import dis
+import threading
+from collections import deque
+from contextlib import contextmanager
 from string import ascii_lowercase, digits
 
 from tagger import api
@@ -11,44 +15,66 @@ _id_chars = set(ascii_lowercase+digits+'_')
 _inputs = {}
 
 
+def make_id(data, tags):
+    """Return the ID given to a node by its data and tags.
+
+    The ID comes from the '_id' tag if there is one, otherwise from the
+    first words of the data. The node's siblings are not looked at.
+
+    return: [str]
+    """
+    if '_id' in tags:
+        name = list(str(tags['_id']))
+        name = ''.join([i for i in name if i in _id_chars])
+    else:
+        name = data.lower()
+        new = []
+        finished = False
+        for char in name:
+            if len(new) > 5:
+                finished = True
+            if char == ' ':
+                if finished:
+                    break
+                new.append('_')
+            if char not in _id_chars:
+                continue
+            new.append(char)
+        name = ''.join(new)
+    name = '_'.join([i for i in name.split('_') if i])
+    if name[0] in digits:
+        name = '_' + name
+    return name
+
+
+def sibling_ids(node):
+    """Return the IDs which update_id keeps a node's ID distinct from.
+
+    return: [set]
+    """
+    try:
+        return {getattr(child, '_id', '') for child in node.parent.children}
+    except AttributeError:
+        return set()  # the root, or a removed node
+
+
 class NodeType:
     """Base type of Node class."""
 
     def __repr__(self):
         return f'{self.__class__.__name__}({self.data})'
 
-    def update_id(self):
-        if '_id' in self.tags:
-            name = list(str(self.tags['_id']))
-            name = ''.join([i for i in name if i in _id_chars])
-        else:
-            name = self.data.lower()
-            new = []
-            finished = False
-            for char in name:
-                if len(new) > 5:
-                    finished = True
-                if char == ' ':
-                    if finished:
-                        break
-                    new.append('_')
-                if char not in _id_chars:
-                    continue
-                new.append(char)
-            name = ''.join(new)
-        name = '_'.join([i for i in name.split('_') if i])
-        if name[0] in digits:
-            name = '_' + name
-        try:
-            changed = True
-            while changed:
-                changed = False
-                for child in self.parent.children:
-                    if getattr(child, '_id', '') == name:
-                        name += '_'
-                        changed = True
-        except AttributeError:
-            pass
+    def update_id(self, used=None):
+        """Set the node's ID, made unique among its siblings.
+
+        used: [optional] IDs taken by the siblings, if already collected
+              for several of them [set]
+        """
+        name = make_id(self.data, self.tags)
+        if used is None:
+            used = sibling_ids(self)
+        while name in used:
+            name += '_'
         self.id = name
 
 
@@ -111,6 +137,307 @@ class Node(NodeType):
         return len(self.parent_list)
 
 
+class LazyNode(Node):
+    """A node whose descendants are created when its children are used.
+
+    Until then _load holds a function which is called with the node and
+    fills in its children, then sets _load to None.
+    """
+
+    _load = None
+
+    @property
+    def children(self):
+        load = self._load
+        if load is not None:
+            load(self)
+        return self._children
+
+    @children.setter
+    def children(self, value):
+        self._children = value
+        self._load = None  # replaced, so never loaded
+
+    @property
+    def loaded(self):
+        return self._load is None
+
+
+class LinkIndex:
+    """Resolve link tags to their target nodes and keep reverse backlinks."""
+
+    def __init__(self, root, link_tags):
+        self.root = root
+        self.link_tags = frozenset(link_tags)
+        self.build()
+
+    def build(self):
+        """Index every node of the tree from the root."""
+        self._keys = {}      # node -> (id, data) it is indexed under
+        self._by_id = {}     # id -> [nodes]
+        self._by_data = {}   # data -> [nodes]
+        self._links = {}     # node -> [link values]
+        self._sources = {}   # link value -> {node: None} (ordered set)
+        self._reachable = {}
+        for node in walk(self.root):
+            self.add(node)
+
+    def __contains__(self, node):
+        return node in self._keys
+
+    def add(self, node):
+        """Index a single node's keys and link tag values."""
+        keys = (node.id, node.data)
+        self._keys[node] = keys
+        self._by_id.setdefault(keys[0], []).append(node)
+        self._by_data.setdefault(keys[1], []).append(node)
+        values = []
+        for tag in self.link_tags:
+            value = node.tags.get(tag)
+            if value is None:
+                continue
+            if isinstance(value, list):
+                values.extend(str(i) for i in value)
+            else:
+                values.append(str(value))
+        if values:
+            self._links[node] = values
+            for value in values:
+                self._sources.setdefault(value, {})[node] = None
+        self._reachable.clear()
+
+    def discard(self, node):
+        """Remove a single node from the index if it is present."""
+        try:
+            id, data = self._keys.pop(node)
+        except KeyError:
+            return
+        _remove_from(self._by_id, id, node)
+        _remove_from(self._by_data, data, node)
+        for value in self._links.pop(node, []):
+            sources = self._sources.get(value)
+            if sources is not None:
+                sources.pop(node, None)
+                if not sources:
+                    del self._sources[value]
+        self._reachable.clear()
+
+    def update(self, node):
+        """Re-index a node after its data, id or tags changed."""
+        self.discard(node)
+        self.add(node)
+
+    def remove_subtree(self, node):
+        """Remove a node and all of its descendants from the index."""
+        for n in walk(node):
+            self.discard(n)
+
+    def resolve(self, value):
+        """Return the nodes a link value refers to (id first, then data)."""
+        return list(self._by_id.get(value) or self._by_data.get(value, []))
+
+    def targets(self, node):
+        """Return the nodes targeted by a node's link tags."""
+        r = {}
+        for value in self._links.get(node, []):
+            for target in self.resolve(value):
+                r[target] = None
+        return list(r)
+
+    def backlinks(self, node):
+        """Return the nodes whose link tags target the given node."""
+        r = {}
+        try:
+            id, data = self._keys[node]
+        except KeyError:
+            return []
+        for source in self._sources.get(id, {}):
+            r[source] = None
+        if not self._by_id.get(data):  # data only used if no id matched
+            for source in self._sources.get(data, {}):
+                r[source] = None
+        return list(r)
+
+    def reachable(self, node):
+        """Return every node reachable from a node by following links.
+
+        The result is cached until the index next changes.
+        """
+        try:
+            return list(self._reachable[node])
+        except KeyError:
+            pass
+        seen = {node: None}
+        queue = deque([node])
+        while queue:
+            current = queue.popleft()
+            for target in self.targets(current):
+                if target not in seen:
+                    seen[target] = None
+                    queue.append(target)
+        del seen[node]
+        self._reachable[node] = r = tuple(seen)
+        return list(r)
+
+
+def walk(node):
+    """Iterate over a node and its descendants in depth-first order."""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node.children))
+
+
+class SnapshotNode:
+    """Copy of a node's data, tags and children, detached from the tree.
+
+    shard: copy of the file mounted below the node, if any (see
+           tagger.shards) [Shard/None]
+    """
+
+    __slots__ = ('data', 'tags', 'children', 'shard')
+
+    def __init__(self, data, tags):
+        self.data = data
+        self.tags = tags
+        self.children = []
+        self.shard = None
+
+
+def snapshot(root):
+    """Copy a subtree so that it can be read while the tree is edited.
+
+    Tag values which are lists are copied; other values are shared.
+
+    root: the node at the top of the subtree [NodeType]
+
+    return: copy of the node [SnapshotNode]
+    """
+    top = SnapshotNode(root.data, _copy_tags(root.tags))
+    stack = [(root, top)]
+    while stack:
+        node, copy = stack.pop()
+        for child in node.children:
+            child_copy = SnapshotNode(child.data, _copy_tags(child.tags))
+            copy.children.append(child_copy)
+            stack.append((child, child_copy))
+    return top
+
+
+def pack(root):
+    """Encode a subtree compactly for sending to another process.
+
+    The encoding is a flat list of (parent index, data, tags) tuples in
+    depth-first order, with -1 as the parent index of the root, so it
+    can be pickled without recursing into the tree.
+
+    root: the node at the top of the subtree [NodeType]
+
+    return: [list: tuple]
+    """
+    packed = []
+    stack = [(root, -1)]
+    while stack:
+        node, parent = stack.pop()
+        index = len(packed)
+        packed.append((parent, node.data, _copy_tags(node.tags)))
+        stack.extend((child, index) for child in reversed(node.children))
+    return packed
+
+
+def unpack(packed):
+    """Rebuild a subtree encoded by pack().
+
+    return: the top of the subtree [SnapshotNode]
+    """
+    nodes = []
+    for parent, data, tags in packed:
+        node = SnapshotNode(data, tags)
+        nodes.append(node)
+        if parent >= 0:
+            nodes[parent].children.append(node)
+    return nodes[0]
+
+
+def _copy_tags(tags):
+    return {k: v.copy() if isinstance(v, list) else v for k, v in tags.items()}
+
+
+def _remove_from(mapping, key, node):
+    nodes = mapping.get(key, [])
+    for i, n in enumerate(nodes):
+        if n is node:
+            del nodes[i]
+            break
+    if not nodes:
+        mapping.pop(key, None)
+
+
+class ReadWriteLock:
+    """Allow either many concurrent readers or a single writer.
+
+    Waiting writers are given priority over new readers. The writer may
+    take the lock again, for reading or writing, without blocking; a
+    reader must not try to take it for writing.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = None  # ident of the thread holding the write lock
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        """Hold the lock for reading for the duration of a with block."""
+        if self._writer == threading.get_ident():
+            yield  # the writer can already read
+            return
+        with self._condition:
+            while self._writer is not None or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        """Hold the lock for writing for the duration of a with block."""
+        acquired = self.acquire_write()
+        try:
+            yield
+        finally:
+            if acquired:
+                self.release_write()
+
+    def acquire_write(self):
+        """Take the lock for writing, waiting for readers to finish.
+
+        return: False if the calling thread already held it [bool]
+        """
+        me = threading.get_ident()
+        if self._writer == me:
+            return False
+        with self._condition:
+            self._waiting_writers += 1
+            while self._writer is not None or self._readers:
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writer = me
+        return True
+
+    def release_write(self):
+        with self._condition:
+            self._writer = None
+            self._condition.notify_all()
+
+
 class Pattern:
     """Produced by input parser to represent text, tags and data points."""
 
@@ -572,9 +899,30 @@ class NameDispatcher:
 
 
 class PluginHookDispatcher(NameDispatcher):
-    def __getattribute__(self, k):
-        if k in _dispatch_names:
-            return object.__getattribute__(self, k)
+    """Dispatch hook calls through a table compiled from registered hooks.
+
+    compile() stores a caller for every hook as an instance attribute, so a
+    hook call is a plain attribute lookup. Hooks which have no effect are
+    left out of the callers and reported by elided(). Hooks (re)assigned
+    since the last compile() are dispatched dynamically through __getattr__.
+
+    passthrough: hook name -> index of the argument a single hook returns
+                 when it does not change its input [dict]
+    """
+
+    __getattribute__ = object.__getattribute__
+
+    def __init__(self, reference, getter_hook=None, setter_hook=None,
+                 passthrough=None):
+        super().__init__(reference, getter_hook, setter_hook)
+        self._callers = {}  # hook name -> (hook list, hook_caller)
+        self._batch_callers = {}
+        self._elided = set()
+        self._passthrough = passthrough or {}
+
+    def __getattr__(self, k):
+        if k in _plugin_dispatch_names:
+            raise AttributeError(k)
         try:
             r = self._dispatch_ref[k]
             if r is None:
@@ -583,15 +931,87 @@ class PluginHookDispatcher(NameDispatcher):
             raise AttributeError(str(e))
         r = self._getter_hook(self._dispatch_ref, k, r)
         if isinstance(r, list):
-            def hook_caller(*args, **kw):
-                # return [hook(*args, **kw) for hook in r]
-                [hook(*args, **kw) for hook in r]
-            hook_caller.__name__ = k + '_hook_caller'
+            cached = self._callers.get(k)
+            if cached is not None and cached[0] is r:
+                return cached[1]
+            hook_caller = _list_caller(k, r)
+            self._callers[k] = (r, hook_caller)
             return hook_caller
         return r
 
+    def compile(self):
+        """Rebuild the dispatch table from the registered hooks.
+
+        Called whenever the set of plugins changes. While api.profiler is
+        enabled every hook caller is timed.
+        """
+        for k in self._dispatch_ref:
+            self.__dict__.pop(k, None)
+        self._batch_callers = {}
+        self._elided = set()
+        for k, r in self._dispatch_ref.items():
+            if r is None:
+                continue
+            r = self._getter_hook(self._dispatch_ref, k, r)
+            if isinstance(r, list):
+                hooks = tuple(h for h in r if hook_effect(h) is None)
+                if not hooks:
+                    self._elided.add(k)
+                    caller = batch_caller = _no_effect
+                elif len(hooks) == 1:
+                    caller = hooks[0]  # list hook return values are unused
+                    batch_caller = _batch_list_caller(hooks)
+                else:
+                    caller = _list_caller(k, hooks)
+                    batch_caller = _batch_list_caller(hooks)
+            else:
+                caller = r
+                batch_caller = _batch_single_caller(r)
+                effect = hook_effect(r)
+                index = self._passthrough.get(k)
+                if effect is not None and effect == index:
+                    self._elided.add(k)
+                    batch_caller = _batch_passthrough(index)
+            if api.profiler.enabled:
+                caller = api.profiler.wrap(f'hook {k}', caller)
+                batch_caller = api.profiler.wrap(f'hook {k} (batch)',
+                                                 batch_caller)
+            object.__setattr__(self, k, caller)
+            self._batch_callers[k] = batch_caller
+
+    def elided(self, k):
+        """Return True if calling a hook has no effect and can be skipped."""
+        return k in self._elided
+
+    def call_batch(self, k, *columns):
+        """Call a hook once for a batch of arguments.
+
+        k: the hook name [str]
+        *columns: one list per hook parameter, e.g. a list of nodes for
+                  post_node_creation_hook [list]
+
+        Hook functions with a '_batch' variant are called once with the
+        lists; other hook functions are called once per set of arguments.
+
+        return: list of return values (single hooks) or None
+        """
+        try:
+            return self._batch_callers[k](*columns)
+        except KeyError:
+            pass
+        try:
+            r = self._dispatch_ref[k]
+            if r is None:
+                return [None] * len(columns[0]) if columns else []
+        except KeyError as e:
+            raise AttributeError(str(e))
+        r = self._getter_hook(self._dispatch_ref, k, r)
+        if isinstance(r, list):
+            return _batch_list_caller(r)(*columns)
+        return _call_batch(r, columns)
+
     def __setattr__(self, k, v):
-        if k in _dispatch_names:
+        if k in _plugin_dispatch_names:
             object.__setattr__(self, k, v)
         else:
             v = self._setter_hook(self._dispatch_ref, k, v)
@@ -599,9 +1019,86 @@ class PluginHookDispatcher(NameDispatcher):
                 self._dispatch_ref[k].append(v)
             elif api.log.importing_main_plugin:
                 self._dispatch_ref[k] = v
+            self.__dict__.pop(k, None)  # dispatch dynamically until compiled
+            self._batch_callers.pop(k, None)
+            self._elided.discard(k)
 
 
 _dispatch_names = ['_dispatch_ref', '_getter_hook', '_setter_hook']
+_plugin_dispatch_names = frozenset([
+    *_dispatch_names, '_callers', '_batch_callers', '_elided',
+    '_passthrough', 'compile', 'elided', 'call_batch'
+])
+
+
+def hook_effect(func):
+    """Find whether a hook function has no effect when called.
+
+    return: 'constant' if it only returns a constant (including None),
+            the index of the parameter it returns unchanged, or None
+    """
+    code = getattr(func, '__code__', None)
+    if code is None or hasattr(func, '_batch'):
+        return None
+    instructions = [i for i in dis.get_instructions(code)
+                    if i.opname not in ('RESUME', 'NOP', 'CACHE')]
+    names = [i.opname for i in instructions]
+    if names in (['RETURN_CONST'], ['LOAD_CONST', 'RETURN_VALUE']):
+        return 'constant'
+    if (len(names) == 2 and names[1] == 'RETURN_VALUE'
+          and names[0] in ('LOAD_FAST', 'LOAD_FAST_BORROW')):
+        params = code.co_varnames[:code.co_argcount]
+        if instructions[0].argval in params:
+            return params.index(instructions[0].argval)
+    return None
+
+
+def _no_effect(*args, **kw):
+    return None
+
+
+def _list_caller(k, hooks):
+    def hook_caller(*args, **kw):
+        for hook in hooks:
+            hook(*args, **kw)
+    hook_caller.__name__ = k + '_hook_caller'
+    return hook_caller
+
+
+def _batch_list_caller(hooks):
+    def batch_caller(*columns):
+        for hook in hooks:
+            _call_batch(hook, columns)
+    return batch_caller
+
+
+def _batch_single_caller(hook):
+    def batch_caller(*columns):
+        return _call_batch(hook, columns)
+    return batch_caller
+
+
+def _batch_passthrough(index):
+    def batch_caller(*columns):
+        return list(columns[index])
+    return batch_caller
+
+
+def _call_batch(hook, columns):
+    batch_hook = getattr(hook, '_batch', None)
+    if batch_hook is not None:
+        return batch_hook(*columns)
+    return [hook(*args) for args in zip(*columns)]
+
+
+def per_item_hook(name, batch_hook):
+    """Adapt a batch hook to be called with a single set of arguments."""
+    def hook(*args):
+        r = batch_hook(*[[arg] for arg in args])
+        return None if r is None else r[0]
+    hook.__name__ = name
+    hook._batch = batch_hook
+    return hook
 
 
 def _is_single(key):
@@ -0,0 +1,46 @@
+"""Tests of reading and writing compressed data files.
+
+Run from the directory containing the tagger package:
+
+    python -m unittest tagger.tests.test_compression
+"""
+
+import gzip
+import os
+import tempfile
+import unittest
+
+from tagger import api
+from tagger import structure
+from tagger.compression import detect
+
+
+class AutosaveCompressionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_autosave_keeps_compression_of_file_name(self):
+        file = os.path.join(self.directory.name, 'data.txt.gz')
+        with gzip.open(file, 'wt') as f:
+            f.write('Data\n*a\n*`k=v\n**b\n*c\n')
+        api.manual_setup(data_source=file)
+        api.make_tree(file=file)
+        api.edit_data('edited', api.tree.root.children[1])
+        expected = structure.pack(api.tree.root)
+        autosave = api.autosave
+        self.assertEqual(autosave.save(), autosave.default_file())
+        autosave.wait()
+        self.assertIsNone(autosave.error)
+        copy = os.path.join(self.directory.name, 'data.txt.autosave.gz')
+        self.assertEqual(autosave.last_file, copy)
+        self.assertEqual(detect(copy), 'gzip')
+        api.make_tree(file=copy)
+        self.assertEqual(structure.pack(api.tree.root), expected)
+        self.assertEqual(sorted(os.listdir(self.directory.name)),
+                         ['data.txt.autosave.gz', 'data.txt.gz'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+"""Tests of data files mounted below nodes tagged with include=FILE.
+
+Run from the directory containing the tagger package:
+
+    python -m unittest tagger.tests.test_shards
+"""
+
+import os
+import tempfile
+import unittest
+
+from tagger import api
+
+
+class ShardSaveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, name, text):
+        file = os.path.join(self.directory.name, name)
+        with open(file, 'w') as f:
+            f.write(text)
+        return file
+
+    def read(self, name):
+        with open(os.path.join(self.directory.name, name)) as f:
+            return f.read()
+
+    def load(self, file):
+        api.manual_setup(data_source=file)
+        api.make_tree(file=file)
+        return api.tree.root
+
+    def test_root_include_edited_and_saved(self):
+        master = self.write('master.txt', 'Master\n`include=inc.txt\n')
+        self.write('inc.txt', 'Included\n*a\n*b\n')
+        root = self.load(master)
+        self.assertEqual([n.data for n in root.children], ['a', 'b'])
+        api.edit_data('edited', root.children[0])
+        api.loaders['default']().save(master)
+        self.assertIn('*edited\n', self.read('inc.txt'))
+        self.assertNotIn('edited', self.read('master.txt'))
+        root = self.load(master)
+        self.assertEqual([n.data for n in root.children], ['edited', 'b'])
+
+    def test_edit_of_included_node_is_saved_to_its_own_file(self):
+        master = self.write('m.txt', 'M\n*top\n*`include=a.txt\n')
+        self.write('a.txt', 'A\n*x\n*`include=b.txt\n')
+        self.write('b.txt', 'B\n*y\n')
+        root = self.load(master)
+        x = root.children[0].children[0]
+        api.edit_data('renamed', x)
+        x.children.append(api.new_node('z', x))
+        api.loaders['default']().save(master)
+        self.assertIn('*renamed\n', self.read('a.txt'))
+        self.assertNotIn('renamed', self.read('b.txt'))
+        self.assertIn('*z\n', self.read('b.txt'))
+        root = self.load(master)
+        api.materialize()
+        x = root.children[0].children[0]
+        self.assertEqual(x.data, 'renamed')
+        self.assertEqual([n.data for n in x.children], ['y', 'z'])
+
+    def test_autosave_writes_copies_of_included_files(self):
+        master = self.write('master.txt',
+                            'Master\n*local\n*team\n*`include=inc.txt\n'
+                            '*other\n*`include=other.txt\n')
+        self.write('inc.txt', 'Included\n*a\n*b\n')
+        self.write('other.txt', 'Other\n*c\n')
+        root = self.load(master)
+        api.edit_data('edited', root.children[1].children[0])
+        autosave = api.autosave
+        copy = autosave.save()
+        autosave.wait()
+        self.assertIsNone(autosave.error)
+        self.assertEqual(self.read('inc.txt'), 'Included\n*a\n*b\n')
+        self.assertIn('*edited\n', self.read('inc.autosave.txt'))
+        self.assertNotIn('edited', self.read('master.autosave.txt'))
+        self.assertNotIn('other.autosave.txt', os.listdir(
+            self.directory.name))  # unchanged files are not copied
+        self.assertTrue(root.children[1].shard.dirty)  # still to be saved
+        root = self.load(copy)
+        api.materialize()
+        self.assertEqual([n.data for n in root.children[1].children],
+                         ['edited', 'b'])
+        self.assertEqual([n.data for n in root.children[2].children], ['c'])
+
+
+if __name__ == '__main__':
+    unittest.main()